@@ -1,23 +1,62 @@
 import streamlit as st
 import openai
 import json
+import logging
 import os
 import pandas as pd
 import io
-
-
-# StreamlitのSecretsからOpenAI API keyを取得
-openai.api_key = st.secrets["OpenAIAPI"]["openai_api_key"]
-
-# DX推進チェックリストを読み込む関数
-def load_dx_checklist():
-    with open("dx_checklist.txt", "r", encoding="utf-8") as file:
-        checklist = file.readlines()
-    return [item.strip() for item in checklist]  # 改行を削除してリスト化
-
-# 回答に関連するチェックリストの要点を取得
-def extract_relevant_checklist(question, checklist):
-    relevant_items = [item for item in checklist if any(keyword in item for keyword in question.split())]
+import time
+import uuid
+from functools import partial
+
+from chat_context import compact_transcript
+from checklist_index import (
+    DEFAULT_KNOWLEDGE_DIR,
+    DEFAULT_RETRIEVAL_MODE,
+    DEFAULT_TOP_K,
+    RETRIEVAL_MODES,
+    KnowledgeBase,
+)
+from llm_utils import (
+    ANSWER_BATCH_SIZE,
+    create_chat_completion,
+    extract_questions,
+    init_openai,
+    parse_batch_answers,
+    parse_category_questions,
+    run_concurrently,
+    run_concurrently_streaming,
+    set_request_owner,
+    split_into_batches,
+)
+from history_view import render_histories
+from message_log import MessageLog
+from run_store import PersonaRunStore
+from vector_index import SemanticAnswerCache
+
+logger = logging.getLogger(__name__)
+
+# StreamlitのSecretsからOpenAI API keyを取得（HTTP接続はプロセス内で共有する）
+init_openai(st.secrets["OpenAIAPI"]["openai_api_key"])
+
+# LLM呼び出しはレート制限の範囲でセッションごとに順番に通すため、このセッションを識別する値を設定する
+if "session_id" not in st.session_state:
+    st.session_state["session_id"] = uuid.uuid4().hex
+set_request_owner(st.session_state["session_id"])
+
+# DX推進チェックリストとナレッジベース（knowledge_base/ 内の資料）のストア
+# 全セッションで共有し、追加・変更されたファイルだけを読み直す
+@st.cache_resource
+def get_checklist_store(path="dx_checklist.txt", knowledge_dir=DEFAULT_KNOWLEDGE_DIR):
+    return KnowledgeBase(paths=[path], directory=knowledge_dir)
+
+checklist_store = get_checklist_store()
+
+# 回答に関連するチェックリストの要点を取得（スコアが min_score 以上のものを関連度順に最大 top_k 件）
+# mode を省略した場合は画面で選択された検索方式（BM25 / ベクトル）を使う
+# stage を指定すると、そのDX推進ステージ向けの要点と全ステージ共通の要点だけを検索する
+def extract_relevant_checklist(question, top_k=DEFAULT_TOP_K, min_score=None, mode=None, stage=None):
+    relevant_items = checklist_store.search(question, top_k, min_score, mode or retrieval_mode, stage)
     return relevant_items if relevant_items else ["関連する情報が見つかりませんでした。"]
 
 
@@ -69,56 +108,96 @@ question_categories = {
 }
 
 # セッションステートの初期化
+# 会話履歴は重複の確認を定数時間で行えるよう、内容の索引を持つ MessageLog に保存する
+# （DX_MESSAGE_ARCHIVE_AFTER を指定すると、古いメッセージは圧縮して保持する）
 if "messages" not in st.session_state:
-    st.session_state["messages"] = [
+    st.session_state["messages"] = MessageLog([
         {"role": "system", "content": f"あなたはDX推進コーチです。{persona['job']}の{persona['name']}さんの課題解決をサポートしてください。"}
-    ]
+    ])
 
 if "feedbacks" not in st.session_state:
     st.session_state["feedbacks"] = []
 
-# **質問生成**
-def generate_questions(persona):
-    questions_by_category = {}
+# **質問生成**（1カテゴリ分のリクエスト）
+def generate_category_questions(persona, category, instruction):
+    prompt = f"""
+    あなたは{persona['job']}の{persona['name']}です。
+    以下の目標と課題、DX推進ステージを踏まえ、{category}に関する質問を1つ考えてください。
 
-    for category, instruction in question_categories.items():
-        prompt = f"""
-        あなたは{persona['job']}の{persona['name']}です。
-        以下の目標と課題、DX推進ステージを踏まえ、{category}に関する質問を1つ考えてください。
+    **目標:** {persona['goals']}
+    **課題:** {persona['challenges']}
+    **DX推進ステージ:** {persona['DX Stages']}
 
-        **目標:** {persona['goals']}
-        **課題:** {persona['challenges']}
-        **DX推進ステージ:** {persona['DX Stages']}
+    **質問の指示:** {instruction}
 
-        **質問の指示:** {instruction}
+    **質問:** 
+    """
 
-        **質問:** 
-        """
+    response = create_chat_completion(
+        use_cache=not regenerate,  # 「新しく生成する」が選ばれた場合はキャッシュを使わない
+        model="gpt-4o-mini",
+        messages=[
+            {"role": "system", "content": "あなたはDX推進のリーダーです。"},
+            {"role": "user", "content": prompt}
+        ],
+        max_tokens=800
+    )
+    # 空行・見出し・前置きを除き、実際の質問文だけを返す（不要な回答生成を防ぐ）
+    return extract_questions(response["choices"][0]["message"]["content"])
+
+# **質問生成**（全カテゴリを1回のリクエストでまとめて生成し、JSONで受け取る）
+# ペルソナの目標・課題・ステージの前置きを1回だけ送るため、入力トークンと往復回数を削減できる
+def generate_all_category_questions(persona):
+    categories_formatted = "\n".join([f"- {category}: {instruction}" for category, instruction in question_categories.items()])
+    prompt = f"""
+    あなたは{persona['job']}の{persona['name']}です。
+    以下の目標と課題、DX推進ステージを踏まえ、各カテゴリに関する質問を1つずつ考えてください。
 
-        try:
-            response = openai.ChatCompletion.create(
-                model="gpt-4o-mini",
-                messages=[
-                    {"role": "system", "content": "あなたはDX推進のリーダーです。"},
-                    {"role": "user", "content": prompt}
-                ],
-                max_tokens=800
-            )
-            questions_by_category[category] = response["choices"][0]["message"]["content"].strip().split("\n")
-        except Exception as e:
-            st.error(f"質問の生成中にエラーが発生しました: {e}")
-            questions_by_category[category] = []
+    **目標:** {persona['goals']}
+    **課題:** {persona['challenges']}
+    **DX推進ステージ:** {persona['DX Stages']}
 
-    return questions_by_category
+    **カテゴリと質問の指示:**
+    {categories_formatted}
 
-# **質問に対するAIの回答生成**
-def chat_with_ai(persona, question):
-    
-     # DX推進チェックリストをロード
-    checklist = load_dx_checklist()
+    【出力フォーマット】
+    カテゴリ名をキー、質問文のリストを値とするJSONオブジェクトのみを出力してください。
+    例: {{"{next(iter(question_categories))}": ["（ここに質問）"], ...}}
+    """
+
+    response = create_chat_completion(
+        use_cache=not regenerate,  # 「新しく生成する」が選ばれた場合はキャッシュを使わない
+        model="gpt-4o-mini",
+        messages=[
+            {"role": "system", "content": "あなたはDX推進のリーダーです。"},
+            {"role": "user", "content": prompt}
+        ],
+        max_tokens=800,
+        response_format={"type": "json_object"}
+    )
+    return parse_category_questions(response["choices"][0]["message"]["content"], list(question_categories))
+
+# 類似質問キャッシュ（全セッションで共有）
+@st.cache_resource
+def get_semantic_cache():
+    return SemanticAnswerCache()
+
+semantic_cache = get_semantic_cache()
+
+# ペルソナの実行結果ストア（全セッションで共有）
+# 同じペルソナ・同じDX推進ステージ・同じアプリの結果は、別のセッションでも生成し直さずに再利用する
+@st.cache_resource
+def get_run_store():
+    return PersonaRunStore()
+
+run_store = get_run_store()
+app_variant = os.path.splitext(os.path.basename(__file__))[0]
+
+# **質問に対するAIの回答生成**（LLMへのリクエスト。st.* を呼ばないため、ワーカースレッドからも利用できる）
+def request_answer(persona, question, on_delta=None):
     
     # 質問に関連するチェックリストの要点を取得
-    relevant_points = extract_relevant_checklist(question, checklist)
+    relevant_points = extract_relevant_checklist(question, stage=persona["DX Stages"])
     relevant_text = "\n".join([f"- {item}" for item in relevant_points])
     
     
@@ -145,54 +224,315 @@ def chat_with_ai(persona, question):
 
     """
 
-    try:
-        response = openai.ChatCompletion.create(
-            model="gpt-4o-mini",
-            messages=[
-                {"role": "system", "content": "あなたはDX推進のプロフェッショナルコーチです。"},
-                {"role": "user", "content": prompt}
-            ],
-            max_tokens=1000,
-            temperature=0.7,  # 創造性を少し抑える
-            top_p=0.9  # 確率的に高い回答を優先
-        )
-        return response["choices"][0]["message"]["content"].strip()
-    except Exception as e:
-        st.error(f"AIの回答生成中にエラーが発生しました: {e}")
-        return "回答を生成できませんでした。"
+    response = create_chat_completion(
+        use_cache=not regenerate,  # 「新しく生成する」が選ばれた場合はキャッシュを使わない
+        model="gpt-4o-mini",
+        messages=[
+            {"role": "system", "content": "あなたはDX推進のプロフェッショナルコーチです。"},
+            {"role": "user", "content": prompt}
+        ],
+        max_tokens=1000,
+        temperature=0.7,  # 創造性を少し抑える
+        top_p=0.9,  # 確率的に高い回答を優先
+        on_delta=on_delta  # ストリーミングの場合は受信した断片を渡す
+    )
+    return response["choices"][0]["message"]["content"].strip()
+
+# 類似質問キャッシュから、同じ職業・同じDX推進ステージで言い換えられた質問の回答を探す（なければ None）
+# 「新しく生成する」が選ばれた場合は探さない（生成した回答はキャッシュに登録する）
+def lookup_cached_answer(persona, question):
+    if not use_semantic_cache or regenerate:
+        return None
+    cached_answer, _ = semantic_cache.lookup((persona["job"], persona["DX Stages"]), question)
+    return cached_answer
+
+# 生成した回答を類似質問キャッシュに登録する
+def remember_answer(persona, question, answer):
+    if use_semantic_cache:
+        semantic_cache.add((persona["job"], persona["DX Stages"]), question, answer)
+
+# **質問に対するAIの回答生成**（類似質問キャッシュを有効にしている場合は、言い換えの質問に過去の回答を再利用する）
+# on_delta を指定するとストリーミングで生成し、受信した断片ごとに on_delta(断片) を呼び出す
+def generate_answer(persona, question, on_delta=None):
+    cached_answer = lookup_cached_answer(persona, question)
+    if cached_answer is not None:
+        if on_delta is not None:
+            on_delta(cached_answer)
+        return cached_answer
+    answer = request_answer(persona, question, on_delta)
+    remember_answer(persona, question, answer)
+    return answer
+
+# **カテゴリ単位のパイプライン**（質問生成 → その質問への回答生成 を1タスクとして実行）
+# 回答のエラーは質問ごとに (質問, None, 例外) として返し、他の質問の結果には影響させない
+# on_delta を指定するとストリーミングで生成し、受信した断片ごとに on_delta(質問, 断片) を呼び出す
+def answer_questions(persona, questions, on_delta=None):
+    results = []
+    for question in questions:
+        try:
+            question_on_delta = partial(on_delta, question) if on_delta is not None else None
+            results.append((question, generate_answer(persona, question, question_on_delta), None))
+        except Exception as e:
+            results.append((question, None, e))
+    return results
+
+def run_category_pipeline(persona, category, instruction, on_delta=None):
+    return answer_questions(persona, generate_category_questions(persona, category, instruction), on_delta)
+
+# **複数の質問への回答をまとめて生成**（共通の指示を1回だけ送り、JSONで質問ごとの回答を受け取る）
+def generate_batch_answers(persona, questions):
+    # 各質問に関連するチェックリストの要点を重複なくまとめ、共通の参考情報として1回だけ送る
+    relevant_points = []
+    for question in questions:
+        for item in extract_relevant_checklist(question, stage=persona["DX Stages"]):
+            if item not in relevant_points:
+                relevant_points.append(item)
+    relevant_text = "\n".join([f"- {item}" for item in relevant_points])
 
-# **質問とAIの回答の表示**
-if st.button(f"{persona['name']}の質問を開始", key="start_questions"):
-    auto_questions = generate_questions(persona)
+    questions_formatted = "\n".join([f"{i+1}. {q}" for i, q in enumerate(questions)])
 
-    for category, questions in auto_questions.items():
-        st.subheader(f"📌 {category} の質問 ({persona['DX Stages']})")
+    prompt = f"""
+    あなたはDX推進のプロフェッショナルコーチです。
+    {persona['job']}の{persona['name']}が以下の{len(questions)}個の質問をしました。
 
-        for question in questions:  
-            # 質問が既に保存されていないかチェック
-            if not any(msg["content"] == question for msg in st.session_state["messages"]):
-                user_message = {"role": "user", "content": question}
-                st.session_state["messages"].append(user_message)
+    質問:
+    {questions_formatted}
 
-            # AIの回答を生成
-            ai_response = chat_with_ai(persona, question)
+    以下のDX推進の重要ポイントを**必ず**参考にする
+     {relevant_text}
+
+    DX推進の知識を活かし、質問ごとに、3つの重要なポイントを挙げて回答してください。
+    **各ポイントは300字以内** で書き、**1つの回答につき合計900字以内** に収めてください。
+    具体的かつ簡潔に、実践的なアドバイスを提供してください。
 
-            # AIの回答が既に保存されていないかチェック
-            if not any(msg["content"] == ai_response for msg in st.session_state["messages"]):
-                ai_message = {"role": "assistant", "content": ai_response}
-                st.session_state["messages"].append(ai_message)
+    【各回答のフォーマット】
 
-            # **質問と回答の表示**
-            st.markdown(f"🙂 **質問:**\n\n{question}")  # 質問の後に改行を追加
-            st.markdown(f"🤖 **AIの回答:**\n\n{ai_response}")  # AIの回答の後に改行を追加
+    1. （ここに300字以内のアドバイス）
+    2. （ここに300字以内のアドバイス）
+    3. （ここに300字以内のアドバイス）
+
+    【出力フォーマット】
+    質問と同じ順序で回答を並べた {{"answers": ["1つ目の質問への回答", ...]}} 形式のJSONオブジェクトのみを出力してください。
+    """
+
+    response = create_chat_completion(
+        use_cache=not regenerate,  # 「新しく生成する」が選ばれた場合はキャッシュを使わない
+        model="gpt-4o-mini",
+        messages=[
+            {"role": "system", "content": "あなたはDX推進のプロフェッショナルコーチです。"},
+            {"role": "user", "content": prompt}
+        ],
+        max_tokens=1000 * len(questions),
+        temperature=0.7,  # 創造性を少し抑える
+        top_p=0.9,  # 確率的に高い回答を優先
+        response_format={"type": "json_object"}
+    )
+    return parse_batch_answers(response["choices"][0]["message"]["content"], len(questions))
+
+# 1バッチ分の質問に回答する。類似質問キャッシュにない質問だけをまとめて生成し、
+# JSONの検証に失敗した場合だけ1問ずつの生成にフォールバックする
+# （レート制限やタイムアウトなどAPIのエラーでは、リクエストを増やさずに質問ごとのエラーとして返す）
+def answer_batch(persona, questions):
+    results = {}
+    pending = []
+    for question in questions:
+        cached_answer = lookup_cached_answer(persona, question)
+        if cached_answer is not None:
+            results[question] = (question, cached_answer, None)
+        elif question not in pending:
+            pending.append(question)
+
+    if len(pending) > 1:
+        try:
+            answers = generate_batch_answers(persona, pending)
+            for question, answer in zip(pending, answers):
+                remember_answer(persona, question, answer)
+                results[question] = (question, answer, None)
+            pending = []
+        except ValueError as e:
+            logger.warning("バッチ回答のJSONが不正なため、1問ずつ生成します: %s", e)
+        except Exception as e:
+            for question in pending:
+                results[question] = (question, None, e)
+            pending = []
+
+    for question in pending:
+        try:
+            answer = request_answer(persona, question)
+            remember_answer(persona, question, answer)
+            results[question] = (question, answer, None)
+        except Exception as e:
+            results[question] = (question, None, e)
+    return [results[question] for question in questions]
+
+# 全カテゴリの質問をバッチに分けて並列に回答し、{カテゴリ: [(質問, 回答, 例外), ...]} に振り分ける
+def answer_questions_in_batches(persona, questions_by_category, batch_size=ANSWER_BATCH_SIZE):
+    pairs = [(category, question) for category, questions in questions_by_category.items() for question in questions]
+    batches = split_into_batches(pairs, batch_size)
+    tasks = {
+        index: partial(answer_batch, persona, [question for _, question in batch])
+        for index, batch in enumerate(batches)
+    }
+    batch_results = {}
+    for index, results, error in run_concurrently(tasks):
+        # バッチ全体が失敗した場合は、そのバッチの質問ごとのエラーにする
+        if error is not None:
+            results = [(question, None, error) for _, question in batches[index]]
+        batch_results[index] = results
+
+    results_by_category = {category: [] for category in questions_by_category}
+    for index, batch in enumerate(batches):
+        for (category, _), result in zip(batch, batch_results[index]):
+            results_by_category[category].append(result)
+    return results_by_category
+
+# 1カテゴリ分の質問と回答をチャット履歴に追加
+def append_category_results(results):
+    for question, ai_response, _ in results:
+        # 質問が既に保存されていないかチェック
+        if not st.session_state["messages"].has_content(question):
+            user_message = {"role": "user", "content": question}
+            st.session_state["messages"].append(user_message)
+
+        # AIの回答が既に保存されていないかチェック
+        if not st.session_state["messages"].has_content(ai_response):
+            ai_message = {"role": "assistant", "content": ai_response}
+            st.session_state["messages"].append(ai_message)
+
+# **質問とAIの回答の表示**
+single_call_questions = st.checkbox("全カテゴリの質問を1回のリクエストでまとめて生成する", value=True)
+batch_answers = st.checkbox("複数の質問への回答を1回のリクエストでまとめて生成する", value=False)
+regenerate = st.checkbox("同じ条件でも新しく生成する（保存済みの結果・LLMの応答キャッシュを使わない）", value=False)
+use_semantic_cache = st.checkbox("言い換えられた類似の質問には過去の回答を再利用する", value=False)
+stream_answers = st.checkbox("回答を生成しながら逐次表示する（ストリーミング。回答をまとめて生成する場合を除く）", value=True)
+retrieval_mode = st.selectbox(
+    "チェックリストの検索方式（bm25: 語の一致 / vector: 埋め込みベクトルの類似度）",
+    RETRIEVAL_MODES,
+    index=RETRIEVAL_MODES.index(DEFAULT_RETRIEVAL_MODE),
+)
+
+# ストリーミングの途中経過を表示する間隔（秒）。断片ごとに描画し直すと通信量が増えるため間引く
+STREAM_RENDER_INTERVAL = 0.1
+
+# カテゴリごとのタスクをストリーミングで実行し、受信中の回答をカテゴリの表示枠に生成途中のまま表示する
+# st.* はメインスレッドでしか呼べないため、ワーカースレッドからは途中経過だけを受け取り、ここで描画する
+# 完了したカテゴリは run_concurrently と同じ (カテゴリ, 結果, 例外) の形で返す
+def stream_category_results(tasks, category_slots):
+    streamed = {category: {} for category in tasks}
+    rendered_at = {}
+    for kind, category, value, error in run_concurrently_streaming(tasks):
+        if kind == "done":
+            yield category, value, error
+            continue
+
+        question, delta = value
+        streamed[category][question] = streamed[category].get(question, "") + delta
+        now = time.monotonic()
+        if now - rendered_at.get(category, 0) < STREAM_RENDER_INTERVAL:
+            continue
+        rendered_at[category] = now
+        with category_slots[category].container():
+            st.subheader(f"📌 {category} の質問 ({persona['DX Stages']})")
+            for streamed_question, streamed_answer in streamed[category].items():
+                st.markdown(f"🙂 **質問:**\n\n{streamed_question}")
+                st.markdown(f"🤖 **AIの回答:**\n\n{streamed_answer}▌")
+
+if st.button(f"{persona['name']}の質問を開始", key="start_questions"):
+    # カテゴリごとの表示枠を先に確保し、カテゴリの処理が終わった順に埋めていく
+    # （ストリーミング中の途中経過は、完了時に同じ枠の中で置き換える）
+    category_slots = {category: st.empty() for category in question_categories}
+
+    # 保存済みの結果があれば再利用する（「新しく生成する」が選ばれた場合は使わない）
+    stored_run = None if regenerate else run_store.get(persona["id"], persona["DX Stages"], app_variant)
+
+    generated_questions = None
+    if stored_run is None and single_call_questions:
+        try:
+            generated_questions = generate_all_category_questions(persona)
+        except Exception as e:
+            # JSONの検証に失敗した場合などは、カテゴリごとのパイプラインにフォールバック
+            st.warning(f"質問の一括生成に失敗したため、カテゴリごとに生成します: {e}")
+
+    if stored_run is not None:
+        st.info("保存済みの結果を表示しています。新しく生成する場合は「同じ条件でも新しく生成する」を選んでください。")
+        completed = (
+            (category, [(question, ai_response, None) for question, ai_response in stored_run["results"].get(category, [])], None)
+            for category in question_categories
+        )
+        for feedback in stored_run["feedbacks"]:
+            if feedback not in st.session_state["feedbacks"]:
+                st.session_state["feedbacks"].append(feedback)
+    elif generated_questions is not None and batch_answers:
+        # 全カテゴリの質問をまとめてバッチ回答し、カテゴリ順に表示する
+        batched_results = answer_questions_in_batches(persona, generated_questions)
+        completed = ((category, batched_results[category], None) for category in question_categories)
+    elif generated_questions is not None:
+        tasks = {
+            category: partial(answer_questions, persona, generated_questions[category])
+            for category in question_categories
+        }
+        completed = stream_category_results(tasks, category_slots) if stream_answers else run_concurrently(tasks)
+    else:
+        tasks = {
+            category: partial(run_category_pipeline, persona, category, instruction)
+            for category, instruction in question_categories.items()
+        }
+        completed = stream_category_results(tasks, category_slots) if stream_answers else run_concurrently(tasks)
+
+    category_order = list(question_categories)
+    finished = {}
+    next_index = 0
+    run_results = {}
+
+    for category, results, error in completed:
+        with category_slots[category].container():
+            st.subheader(f"📌 {category} の質問 ({persona['DX Stages']})")
+
+            if error is not None:
+                st.error(f"質問の生成中にエラーが発生しました（{category}）: {error}")
+                results = []
+
+            for i, (question, ai_response, answer_error) in enumerate(results):
+                if answer_error is not None:
+                    st.error(f"AIの回答生成中にエラーが発生しました: {answer_error}")
+                    ai_response = "回答を生成できませんでした。"
+                    results[i] = (question, ai_response, answer_error)
+
+                # **質問と回答の表示**
+                st.markdown(f"🙂 **質問:**\n\n{question}")  # 質問の後に改行を追加
+                st.markdown(f"🤖 **AIの回答:**\n\n{ai_response}")  # AIの回答の後に改行を追加
+
+        if error is None and results and all(answer_error is None for _, _, answer_error in results):
+            run_results[category] = [(question, ai_response) for question, ai_response, _ in results]
+
+        # 完了順に依存しないよう、先頭から揃ったカテゴリだけをカテゴリ順に履歴へ追加
+        finished[category] = results
+        while next_index < len(category_order) and category_order[next_index] in finished:
+            append_category_results(finished.pop(category_order[next_index]))
+            next_index += 1
+
+    # 新しく生成した結果は、全カテゴリの回答が揃った場合だけ保存して他のセッションと共有する
+    if stored_run is None and len(run_results) == len(category_order):
+        run_store.save_results(persona["id"], persona["DX Stages"], app_variant, run_results)
+
+# 類似質問キャッシュのヒット率と類似度の分布
+if use_semantic_cache:
+    with st.expander("類似質問キャッシュの統計"):
+        st.write(semantic_cache.stats())
+
+# このセッションの会話履歴のメモリ使用量
+with st.expander("会話履歴のメモリ使用量"):
+    st.write(st.session_state["messages"].memory_stats())
 
 
 # ペルソナからのフィードバック生成
-def generate_feedback(persona, chat_history):
+# placeholder（st.empty()）を指定するとストリーミングで生成し、受信した内容をその場で表示する
+def generate_feedback(persona, chat_history, placeholder=None):
     #　セッションに保存された DX ステージを取得（なければ現在のものを使用）
     dx_stage = st.session_state.get("dx_stage", persona["DX Stages"])
     
-    chat_content = "\n".join([msg["content"] for msg in chat_history if msg["role"] in ["user", "assistant"]])
+    # 会話履歴は重複を除き、アドバイスの要点だけに圧縮して上限のトークン数に収める
+    chat_content = compact_transcript(chat_history)
     
     questions_formatted = "\n".join([f"{i+1}. {q}" for i, q in enumerate(interview_questions)])
     
@@ -210,8 +550,16 @@ def generate_feedback(persona, chat_history):
     回答:
     """
 
+    streamed = []
+
+    def show_delta(delta):
+        streamed.append(delta)
+        placeholder.markdown("".join(streamed) + "▌")
+
     try:
-        response = openai.ChatCompletion.create(
+        response = create_chat_completion(
+            use_cache=not regenerate,  # 「新しく生成する」が選ばれた場合はキャッシュを使わない
+            on_delta=show_delta if placeholder is not None else None,
             model="gpt-4o-mini",
             messages=[
                 {"role": "system", "content": "あなたはDX推進リーダーとしてチャットボットを利用し評価する立場の人です。"},
@@ -222,6 +570,7 @@ def generate_feedback(persona, chat_history):
         )
         feedback = response["choices"][0]["message"]["content"].strip()
         st.session_state["feedbacks"].append(feedback)
+        run_store.add_feedback(persona["id"], persona["DX Stages"], app_variant, feedback)
         return feedback
     except openai.error.OpenAIError as e:
         st.error(f"OpenAI APIでエラーが発生しました: {e}")
@@ -229,25 +578,18 @@ def generate_feedback(persona, chat_history):
 
 # **フィードバックボタンを最後に配置**
 if st.button(f"{persona['name']}さんからフィードバックを取得"):
-    feedback = generate_feedback(persona, st.session_state["messages"])
-    st.markdown(f"📜 **{persona['name']}さんのフィードバック:**\n\n{feedback}")
-
-# チャット履歴の表示
-if st.session_state["messages"]:
-    for message in reversed(st.session_state["messages"][1:]):
-        speaker = "🙂" if message["role"] == "user" else "🤖"
-        st.write(f"{speaker}: {message['content']}")
+    st.markdown(f"📜 **{persona['name']}さんのフィードバック:**")
+    feedback_placeholder = st.empty()
+    feedback = generate_feedback(persona, st.session_state["messages"], feedback_placeholder if stream_answers else None)
+    feedback_placeholder.markdown(feedback)
 
-# フィードバック履歴の表示
-if st.session_state["feedbacks"]:
-    st.write("📄 これまでのフィードバック履歴:")
-    for feedback in reversed(st.session_state["feedbacks"]):
-        st.write(feedback)
+# チャット履歴・フィードバック履歴の表示（新しい順に1ページ分ずつ）
+render_histories(st.session_state["messages"], st.session_state["feedbacks"])
 
 # チャット履歴をExcelに保存
 def save_chat_history_to_excel(persona_id, messages):
     if messages:
-        df = pd.DataFrame(messages)
+        df = pd.DataFrame(messages, columns=["role", "content"])
         filename = f"chat_history_persona_{persona_id}.xlsx"
         df.to_excel(filename, index=False, encoding="utf-8", engine="openpyxl")
         return filename
@@ -1,10 +1,12 @@
 import streamlit as st
-import openai
 import json
 import os
+from chat_context import ChatContext
+from history_view import render_histories
+from llm_utils import call_chat_completion, init_openai
 
-# StreamlitのSecretsからOpenAI API keyを取得
-openai.api_key = st.secrets["OpenAIAPI"]["openai_api_key"]
+# StreamlitのSecretsからOpenAI API keyを取得（HTTP接続はプロセス内で共有する）
+init_openai(st.secrets["OpenAIAPI"]["openai_api_key"])
 
 # ペルソナの読み込み
 def load_personas(file_path):
@@ -42,6 +44,10 @@ if "messages" not in st.session_state:
         {"role": "system", "content": f"あなたはDX推進コーチです。{persona['job']}の{persona['name']}さんの課題解決をサポートしてください。"}
     ]
 
+# 会話の文脈（直近のやり取りと、それより古いやり取りの要約）。毎回の呼び出しで履歴全体を送らないようにする
+if "chat_context" not in st.session_state:
+    st.session_state["chat_context"] = ChatContext(model="gpt-4")
+
 # OpenAIを使ってペルソナが質問を生成
 def generate_questions(persona):
     prompt = f"""
@@ -56,7 +62,7 @@ def generate_questions(persona):
     
     try:
         # OpenAIの最新API形式に対応
-        response = openai.ChatCompletion.create(
+        response = call_chat_completion(
             model="gpt-4",
             messages=[
                 {"role": "system", "content": "あなたはプロフェッショナルなDX推進コンサルタントです。"},
@@ -80,20 +86,17 @@ if st.button(f"{persona['name']}さんの自動生成質問を開始"):
         st.session_state["messages"].append(user_message)
         
         try:
-            response = openai.ChatCompletion.create(
+            response = call_chat_completion(
                 model="gpt-4",
-                messages=st.session_state["messages"]
+                messages=st.session_state["chat_context"].build_messages(st.session_state["messages"])
             )
             bot_message = response.choices[0].message
             st.session_state["messages"].append(bot_message)
         except Exception as e:
             st.error(f"エラーが発生しました: {e}")
 
-# チャット履歴の表示
-if st.session_state["messages"]:
-    for message in reversed(st.session_state["messages"][1:]):
-        speaker = "🙂" if message["role"] == "user" else "🤖"
-        st.write(f"{speaker}: {message['content']}")
+# チャット履歴の表示（新しい順に1ページ分ずつ）
+render_histories(st.session_state["messages"])
 
 # インタビューの実施
 if st.button("インタビューを開始 / 次の質問"):
@@ -4,9 +4,12 @@ import json
 import os
 import pandas as pd
 import io
+from chat_context import ChatContext, compact_transcript
+from history_view import render_histories
+from llm_utils import call_chat_completion, init_openai
 
-# StreamlitのSecretsからOpenAI API keyを取得
-openai.api_key = st.secrets["OpenAIAPI"]["openai_api_key"]
+# StreamlitのSecretsからOpenAI API keyを取得（HTTP接続はプロセス内で共有する）
+init_openai(st.secrets["OpenAIAPI"]["openai_api_key"])
 
 # ペルソナの読み込み
 def load_personas(file_path):
@@ -51,6 +54,10 @@ if "messages" not in st.session_state:
         {"role": "system", "content": f"あなたはDX推進コーチです。{persona['job']}の{persona['name']}さんの課題解決をサポートしてください。"}
     ]
 
+# 会話の文脈（直近のやり取りと、それより古いやり取りの要約）。毎回の呼び出しで履歴全体を送らないようにする
+if "chat_context" not in st.session_state:
+    st.session_state["chat_context"] = ChatContext(model="gpt-4o-mini")
+
 if "feedbacks" not in st.session_state:
     st.session_state["feedbacks"] = []
 
@@ -71,7 +78,7 @@ def generate_questions(persona):
     """
     
     try:
-        response = openai.ChatCompletion.create(
+        response = call_chat_completion(
             model="gpt-4o-mini",
             messages=[
                 {"role": "system", "content": "あなたはDX推進リーダーとしてチャットボットを活用し、評価する立場です。"},
@@ -87,7 +94,8 @@ def generate_questions(persona):
 
 # ペルソナからのフィードバック生成
 def generate_feedback(persona, chat_history):
-    chat_content = "\n".join([msg["content"] for msg in chat_history if msg["role"] in ["user", "assistant"]])
+    # 会話履歴は重複を除き、アドバイスの要点だけに圧縮して上限のトークン数に収める
+    chat_content = compact_transcript(chat_history)
     
     questions_formatted = "\n".join([f"{i+1}. {q}" for i, q in enumerate(interview_questions)])
     
@@ -105,7 +113,7 @@ def generate_feedback(persona, chat_history):
     """
 
     try:
-        response = openai.ChatCompletion.create(
+        response = call_chat_completion(
             model="gpt-4o-mini",
             messages=[
                 {"role": "system", "content": "あなたはプロフェッショナルなDX推進コンサルタントです。"},
@@ -129,9 +137,9 @@ if st.button(f"{persona['name']}さんの自動生成質問を開始"):
         st.session_state["messages"].append(user_message)
         
         try:
-            response = openai.ChatCompletion.create(
+            response = call_chat_completion(
                 model="gpt-4o-mini",
-                messages=st.session_state["messages"]
+                messages=st.session_state["chat_context"].build_messages(st.session_state["messages"])
             )
             bot_message = response["choices"][0]["message"]
             st.session_state["messages"].append(bot_message)
@@ -144,17 +152,8 @@ if st.button(f"{persona['name']}さんからフィードバックを取得"):
     st.write(f"📜 {persona['name']}さんのフィードバック:")
     st.write(feedback)
 
-# チャット履歴の表示
-if st.session_state["messages"]:
-    for message in reversed(st.session_state["messages"][1:]):
-        speaker = "🙂" if message["role"] == "user" else "🤖"
-        st.write(f"{speaker}: {message['content']}")
-
-# フィードバック履歴の表示
-if st.session_state["feedbacks"]:
-    st.write("📄 これまでのフィードバック履歴:")
-    for feedback in reversed(st.session_state["feedbacks"]):
-        st.write(feedback)
+# チャット履歴・フィードバック履歴の表示（新しい順に1ページ分ずつ）
+render_histories(st.session_state["messages"], st.session_state["feedbacks"])
 
 # チャット履歴をExcelに保存
 def save_chat_history_to_excel(persona_id, messages):
@@ -0,0 +1,209 @@
+import os
+import re
+
+from llm_utils import call_chat_completion, count_message_tokens, count_tokens, truncate_to_tokens
+
+# 会話でそのまま送る直近のやり取りの往復数（環境変数 DX_CHAT_KEEP_TURNS で変更可能）
+CHAT_KEEP_TURNS = int(os.environ.get("DX_CHAT_KEEP_TURNS", "3"))
+# 1回の呼び出しで送るメッセージ全体のトークン数の上限
+CHAT_CONTEXT_TOKENS = int(os.environ.get("DX_CHAT_CONTEXT_TOKENS", "6000"))
+# 古いやり取りをまとめた要約のトークン数の上限
+CHAT_SUMMARY_TOKENS = int(os.environ.get("DX_CHAT_SUMMARY_TOKENS", "600"))
+
+# フィードバック生成で送る会話記録のトークン数の上限と、アドバイス1項目あたりの上限
+FEEDBACK_TRANSCRIPT_TOKENS = int(os.environ.get("DX_FEEDBACK_TRANSCRIPT_TOKENS", "3000"))
+ADVICE_POINT_TOKENS = int(os.environ.get("DX_ADVICE_POINT_TOKENS", "150"))
+
+SPEAKER_LABELS = {"user": "相談者", "assistant": "コーチ"}
+
+_ADVICE_POINT_PATTERN = re.compile(r"^\s*(?:[#*]+\s*)?\d+\s*[.)）．、]\s*")
+_HEADLINE_PATTERN = re.compile(r"^(?:\*\*(.+?)\*\*|(.+?)[。:：])")
+
+
+# これまでの要約に新しいやり取りを反映した要約を作る
+def summarize_messages(summary, messages, model, max_tokens=CHAT_SUMMARY_TOKENS):
+    conversation = "\n".join(
+        [f"{SPEAKER_LABELS.get(message['role'], message['role'])}: {message['content']}" for message in messages]
+    )
+    prompt = f"""
+    以下の「これまでの要約」に「新しいやり取り」の内容を反映し、会話全体の要約を更新してください。
+    相談者の質問と、コーチが示したアドバイスの要点を残し、{max_tokens}字以内の箇条書きにまとめてください。
+
+    これまでの要約:
+    {summary or "（なし）"}
+
+    新しいやり取り:
+    {conversation}
+
+    更新した要約:
+    """
+
+    response = call_chat_completion(
+        model=model,
+        messages=[
+            {"role": "system", "content": "あなたは会話の記録を簡潔に要約するアシスタントです。"},
+            {"role": "user", "content": prompt}
+        ],
+        max_tokens=max_tokens,
+        temperature=0.3
+    )
+    return truncate_to_tokens(response["choices"][0]["message"]["content"].strip(), max_tokens)
+
+
+# マルチターンの会話で毎回送るメッセージを組み立てる（セッションごとに st.session_state に保持する）
+# システムプロンプトと直近 keep_turns 往復のやり取りはそのまま送り、それより古いやり取りは要約にまとめる
+# 要約は直近の範囲から外れたやり取りが summary_batch_turns 往復（既定は keep_turns）たまるごとにまとめて更新し、
+# それまでは外れたやり取りもそのまま送る（1往復ごとに要約のリクエストが増えないようにする）
+# 送るメッセージ全体が max_tokens を超える場合は、たまった数に関係なく要約する
+class ChatContext:
+    def __init__(self, model, keep_turns=CHAT_KEEP_TURNS, max_tokens=CHAT_CONTEXT_TOKENS, summary_tokens=CHAT_SUMMARY_TOKENS,
+                 summary_batch_turns=None):
+        self.model = model
+        self.keep_turns = keep_turns
+        self.summary_batch_turns = max(1, keep_turns if summary_batch_turns is None else summary_batch_turns)
+        self.max_tokens = max_tokens
+        self.summary_tokens = summary_tokens
+        self.summary = ""
+        self.summarized_count = 0  # 先頭のシステムプロンプトを除き、要約に含めたメッセージの件数
+
+    def _summary_message(self, summary):
+        return {"role": "system", "content": f"これまでの会話の要約:\n{summary}"}
+
+    # 直近 keep_turns 往復の始まり（後ろから keep_turns 番目のユーザーの発言）の位置
+    def _recent_start(self, history):
+        user_indexes = [i for i, message in enumerate(history) if message["role"] == "user"]
+        if len(user_indexes) <= self.keep_turns:
+            return 0
+        return user_indexes[-self.keep_turns] if self.keep_turns > 0 else len(history)
+
+    # messages（先頭がシステムプロンプトの会話履歴）から、LLMに送るメッセージのリストを作る
+    def build_messages(self, messages):
+        system_message, history = messages[0], messages[1:]
+        # 履歴が消去・短縮された場合は要約を作り直す
+        if self.summarized_count > len(history):
+            self.summary = ""
+            self.summarized_count = 0
+
+        recent_start = max(self._recent_start(history), self.summarized_count)
+        # 直近の範囲から外れたやり取りが summary_batch_turns 往復に満たなければ、要約せずにそのまま送る
+        outside_turns = sum(1 for message in history[self.summarized_count:recent_start] if message["role"] == "user")
+        start = recent_start if outside_turns >= self.summary_batch_turns else self.summarized_count
+        # 上限を超える場合は、古いものから要約に回す（最後の発言は必ずそのまま残す）
+        reserved = count_message_tokens([system_message, self._summary_message("")]) + self.summary_tokens
+        while start < len(history) - 1 and reserved + count_message_tokens(history[start:]) > self.max_tokens:
+            start += 1
+        # 要約する場合は、直近の範囲から外れたやり取りをまとめて要約する
+        if start > self.summarized_count:
+            start = max(start, recent_start)
+
+        if start > self.summarized_count:
+            self.summary = summarize_messages(
+                self.summary, history[self.summarized_count:start], self.model, self.summary_tokens
+            )
+            self.summarized_count = start
+
+        context = [system_message]
+        if self.summary:
+            context.append(self._summary_message(self.summary))
+        context.extend(history[start:])
+
+        # それでも上限を超える場合（最後の発言が長い場合など）は、最後の発言の末尾を切り詰める
+        overflow = count_message_tokens(context) - self.max_tokens
+        if overflow > 0:
+            last = context[-1]
+            context[-1] = {
+                "role": last["role"],
+                "content": truncate_to_tokens(last["content"], max(1, count_tokens(last["content"]) - overflow)),
+            }
+        return context
+
+
+# 回答から「1. 〜」「2. 〜」「3. 〜」の番号付きのアドバイスを最大 max_points 件取り出す
+# 番号付きの項目がない場合は回答全体を1件として扱う
+def extract_advice_points(answer, max_points=3):
+    points = []
+    for line in (answer or "").splitlines():
+        if _ADVICE_POINT_PATTERN.match(line):
+            points.append(_ADVICE_POINT_PATTERN.sub("", line).strip())
+        elif points and line.strip():
+            points[-1] = f"{points[-1]} {line.strip()}"
+    points = [point for point in points if point]
+    return points[:max_points] if points else [" ".join((answer or "").split())]
+
+
+# アドバイスの見出し（「**見出し**」または最初の文）だけを取り出す
+def _advice_headline(point):
+    match = _HEADLINE_PATTERN.match(point)
+    headline = (match.group(1) or match.group(2)) if match else point
+    return truncate_to_tokens(headline.replace("**", "").strip(), ADVICE_POINT_TOKENS // 3)
+
+
+# compact_transcript で exchanges を記録のブロックに書き出す
+# mode が "full" ならアドバイスをそのまま、"capped" なら1項目 ADVICE_POINT_TOKENS まで、"headline" なら見出しだけにする
+# 同じ質問・同じアドバイスは渡したやり取りの中で1回だけ残す（省略したやり取りを「前出」として参照しない）
+def _render_exchanges(exchanges, mode):
+    blocks = []
+    seen_questions = set()
+    seen_points = set()
+    seen_headlines = set()
+    for question, points in exchanges:
+        repeated = False
+        if question:
+            key = " ".join(question.split())
+            repeated = key in seen_questions
+            seen_questions.add(key)
+        texts = []
+        for number, point in points:
+            key = " ".join(point.split())
+            if key in seen_points:
+                continue
+            seen_points.add(key)
+            if mode == "headline":
+                text = _advice_headline(point)
+                if text in seen_headlines:
+                    continue
+                seen_headlines.add(text)
+            elif mode == "capped":
+                text = truncate_to_tokens(point, ADVICE_POINT_TOKENS)
+            else:
+                text = point
+            texts.append(f"  {number}. {text}")
+        # 繰り返された質問で、新しいアドバイスもないやり取りは残さない
+        if repeated and not texts:
+            continue
+        lines = [f"質問: {'（前出の質問と同じ）' if repeated else question}"] if question else []
+        lines.append("回答の要点:" if texts else "回答の要点: （前出の回答と同じ）")
+        blocks.append("\n".join(lines + texts))
+    return blocks
+
+
+# フィードバック生成用に、会話履歴を max_tokens 以内の記録にまとめる
+# 同じ質問・同じアドバイスは1回だけ残し、回答は番号付きのアドバイスの要点だけにする
+# 上限を超える場合は、アドバイスを1項目ずつ切り詰め、次に見出しだけにし、最後に古いやり取りから省略する
+def compact_transcript(messages, max_tokens=FEEDBACK_TRANSCRIPT_TOKENS):
+    exchanges = []  # [(質問（質問がなければ ""）, [(アドバイスの番号, アドバイス), ...]), ...]
+    for message in messages:
+        content = (message.get("content") or "").strip()
+        if message["role"] not in ("user", "assistant") or not content:
+            continue
+        if message["role"] == "user":
+            exchanges.append((content, []))
+        else:
+            if not exchanges or exchanges[-1][1]:
+                exchanges.append(("", []))
+            exchanges[-1][1].extend(enumerate(extract_advice_points(content), 1))
+
+    for mode in ("full", "capped", "headline"):
+        transcript = "\n".join(_render_exchanges(exchanges, mode))
+        if count_tokens(transcript) <= max_tokens:
+            return transcript
+
+    # 古いやり取りから省略し、残したやり取りだけで記録を作り直す
+    omitted_note = "（古いやり取り{}件は省略）"
+    for start in range(1, len(exchanges)):
+        transcript = "\n".join([omitted_note.format(start)] + _render_exchanges(exchanges[start:], "headline"))
+        if count_tokens(transcript) <= max_tokens:
+            return transcript
+    # 最新のやり取りだけでも収まらない場合は末尾を切り詰める
+    lines = [omitted_note.format(len(exchanges) - 1)] if len(exchanges) > 1 else []
+    return truncate_to_tokens("\n".join(lines + _render_exchanges(exchanges[-1:], "headline")), max_tokens)
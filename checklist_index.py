@@ -0,0 +1,501 @@
+import hashlib
+import logging
+import math
+import os
+import re
+import threading
+import time
+import unicodedata
+from collections import OrderedDict, defaultdict
+
+import numpy as np
+
+from text_utils import NGRAM_SIZES, char_ngrams
+from vector_index import DEFAULT_MIN_SIMILARITY, EmbeddingStore, VectorIndex, create_embedder
+
+_logger = logging.getLogger(__name__)
+
+# 検索結果として返す件数とBM25スコアの下限の既定値（環境変数 DX_RAG_TOP_K / DX_RAG_MIN_SCORE で変更可能）
+DEFAULT_TOP_K = int(os.environ.get("DX_RAG_TOP_K", "3"))
+DEFAULT_MIN_SCORE = float(os.environ.get("DX_RAG_MIN_SCORE", "3.0"))
+# BM25のパラメータ（k1: 出現回数の飽和の強さ、b: 文書長による正規化の強さ）
+BM25_K1 = 1.5
+BM25_B = 0.75
+# チェックリストの検索方式（"bm25" または "vector"。環境変数 DX_RAG_MODE で変更可能）
+RETRIEVAL_MODES = ("bm25", "vector")
+DEFAULT_RETRIEVAL_MODE = os.environ.get("DX_RAG_MODE", "bm25")
+# 埋め込みを保存するディレクトリ（環境変数 DX_RAG_INDEX_DIR で変更可能。空文字列なら保存しない）
+DEFAULT_INDEX_DIR = os.environ.get("DX_RAG_INDEX_DIR", ".rag_index")
+# 資料を置くナレッジベースのディレクトリと、検索対象にする拡張子（環境変数 DX_RAG_KNOWLEDGE_DIR で変更可能）
+DEFAULT_KNOWLEDGE_DIR = os.environ.get("DX_RAG_KNOWLEDGE_DIR", "knowledge_base")
+KNOWLEDGE_EXTENSIONS = (".txt", ".md")
+# ファイルの変更を確認する最短の間隔（秒）。回答ごとにディレクトリを走査しないようにする
+REFRESH_INTERVAL = float(os.environ.get("DX_RAG_REFRESH_INTERVAL", "2.0"))
+# 検索結果をキャッシュする件数の上限（環境変数 DX_RAG_SEARCH_CACHE_SIZE で変更可能）
+SEARCH_CACHE_SIZE = int(os.environ.get("DX_RAG_SEARCH_CACHE_SIZE", "1024"))
+
+
+# 文字n-gramの転置インデックスによるBM25検索
+# 各n-gramのポスティング（文書番号の配列と出現回数の配列）を持ち、検索時はクエリに含まれるn-gramの
+# ポスティングからBM25の重みをNumPyでまとめて計算して足し合わせる
+# 重みを構築時に固定しないため、文書の追加・削除は変わったn-gramのポスティングを差し替えるだけで済む（updated）
+# documents の None は空き（削除した文書や、この索引に含めない文書）で、ポスティングにも文書数にも含めない
+# （DX推進ステージごとの索引は、全体の索引と同じ文書番号のまま、そのステージの文書だけを持つ）
+class BM25Index:
+    # doc_counts に各文書の文字n-gramの出現回数を渡すと、その集計を再利用する
+    def __init__(self, documents, sizes=NGRAM_SIZES, k1=BM25_K1, b=BM25_B, doc_counts=None):
+        self.documents = list(documents)  # 文書番号 -> 文書（空きは None）
+        self.sizes = sizes
+        self.k1 = k1
+        self.b = b
+        if doc_counts is None:
+            doc_counts = [char_ngrams(document, sizes) if document is not None else {} for document in self.documents]
+        self.doc_lengths = np.array([sum(counts.values()) for counts in doc_counts], dtype=np.float32)
+        self.live_count = sum(document is not None for document in self.documents)
+
+        postings = defaultdict(lambda: ([], []))  # n-gram -> ([文書番号, ...], [出現回数, ...])
+        for doc_id, counts in enumerate(doc_counts):
+            for gram, count in counts.items():
+                postings[gram][0].append(doc_id)
+                postings[gram][1].append(count)
+        self.postings = {  # n-gram -> (文書番号の配列, 出現回数の配列)
+            gram: (np.array(doc_ids, dtype=np.int32), np.array(counts, dtype=np.float32))
+            for gram, (doc_ids, counts) in postings.items()
+        }
+
+    # 空きのまま残っている文書番号の数
+    @property
+    def removed_count(self):
+        return len(self.documents) - self.live_count
+
+    # 文書を削除・追加した新しいインデックスを返す（自身は変更しないため、検索中のスレッドにも影響しない）
+    # removed_ids は削除する文書番号、removed_counts はその文書の文字n-gramの出現回数（ポスティングから除くのに使う）
+    # 削除した文書番号は空きとして残し、追加した文書は末尾に並べるため、既存の文書番号は変わらない
+    # documents に None を含めると、その文書番号を空きのまま確保する（doc_counts は空の辞書にする）
+    # 作り直すのは削除・追加した文書に含まれるn-gramのポスティングだけなので、かかる時間は変更の大きさに比例する
+    def updated(self, removed_ids, removed_counts, documents, doc_counts):
+        index = object.__new__(BM25Index)
+        index.sizes = self.sizes
+        index.k1 = self.k1
+        index.b = self.b
+        start = len(self.documents)
+        index.documents = self.documents + list(documents)
+        index.doc_lengths = np.concatenate(
+            [self.doc_lengths, np.array([sum(counts.values()) for counts in doc_counts], dtype=np.float32)]
+        )
+        removed_ids = np.array(sorted(removed_ids), dtype=np.int32)
+        for doc_id in removed_ids:
+            index.documents[doc_id] = None
+        index.doc_lengths[removed_ids] = 0
+        index.live_count = self.live_count - len(removed_ids) + sum(document is not None for document in documents)
+
+        added = defaultdict(lambda: ([], []))
+        for offset, counts in enumerate(doc_counts):
+            for gram, count in counts.items():
+                added[gram][0].append(start + offset)
+                added[gram][1].append(count)
+        removed_grams = set()
+        for counts in removed_counts:
+            removed_grams.update(counts)
+
+        index.postings = dict(self.postings)
+        for gram in removed_grams | set(added):
+            doc_ids, counts = self.postings.get(gram, (np.empty(0, dtype=np.int32), np.empty(0, dtype=np.float32)))
+            if gram in removed_grams:
+                keep = ~np.isin(doc_ids, removed_ids)
+                doc_ids, counts = doc_ids[keep], counts[keep]
+            if gram in added:
+                doc_ids = np.concatenate([doc_ids, np.array(added[gram][0], dtype=np.int32)])
+                counts = np.concatenate([counts, np.array(added[gram][1], dtype=np.float32)])
+            if len(doc_ids):
+                index.postings[gram] = (doc_ids, counts)
+            else:
+                index.postings.pop(gram, None)
+        return index
+
+    # クエリとのBM25スコアが min_score 以上の文書を、スコアの高い順に (文書番号, スコア) で最大 top_k 件返す
+    def search(self, query, top_k=DEFAULT_TOP_K, min_score=DEFAULT_MIN_SCORE):
+        if not self.live_count or top_k <= 0:
+            return []
+        k1, b = self.k1, self.b
+        total = self.live_count
+        average_length = float(self.doc_lengths.sum()) / total
+        scores = np.zeros(len(self.documents), dtype=np.float32)
+        for gram in char_ngrams(query, self.sizes):
+            posting = self.postings.get(gram)
+            if posting is None:
+                continue
+            doc_ids, tf = posting
+            idf = math.log(1 + (total - len(doc_ids) + 0.5) / (len(doc_ids) + 0.5))
+            norm = k1 * (1 - b + b * self.doc_lengths[doc_ids] / average_length)
+            scores[doc_ids] += idf * tf * (k1 + 1) / (tf + norm)
+
+        candidates = np.flatnonzero(scores >= max(min_score, np.finfo(np.float32).tiny))
+        if len(candidates) > top_k:
+            candidates = candidates[np.argpartition(-scores[candidates], top_k - 1)[:top_k]]
+        candidates = candidates[np.argsort(-scores[candidates], kind="stable")]
+        return [(int(doc_id), float(scores[doc_id])) for doc_id in candidates]
+
+
+# 件数に上限のあるLRUキャッシュ（スレッドセーフ）。ヒット数・ミス数を記録する
+class LRUCache:
+    def __init__(self, max_size=SEARCH_CACHE_SIZE):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    # キーに対応する値を返す（なければ default）。見つかった値は最近使ったものとして末尾に移す
+    def get(self, key, default=None):
+        with self._lock:
+            if key in self._data:
+                self._data.move_to_end(key)
+                self.hits += 1
+                return self._data[key]
+            self.misses += 1
+            return default
+
+    def put(self, key, value):
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    # ヒット数・ミス数・件数・ヒット率を返す
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "size": len(self._data),
+                "hit_rate": self.hits / total if total else 0.0,
+            }
+
+
+# キャッシュのキーにするため、質問の表記ゆれ（全角/半角・大文字/小文字・空白・末尾の記号）をそろえる
+def normalize_question(question):
+    question = unicodedata.normalize("NFKC", question).lower()
+    return " ".join(question.split()).rstrip("?？。.!！ ")
+
+
+# DX推進ステージ
+# 資料側で見出しの末尾に「[導入前]」「[導入初期・導入推進中]」のように対象のステージを明示する
+# トピックのタグはセクションのタグより優先し、タグのない資料だけ STAGE_KEYWORDS の汎用的な語で判定する
+# どのステージにも当てはまらないチャンクと、「[共通]」を付けたチャンクは全ステージ共通として扱う
+# （セクションにタグがあっても、経営層の関与のようにどのステージにも関わるトピックは「[共通]」にする）
+DX_STAGES = ("導入前", "導入初期", "導入推進中", "定着期")
+SHARED_STAGE_TAG = "共通"
+STAGE_KEYWORDS = {
+    "導入前": ("導入前", "導入準備"),
+    "導入初期": ("導入初期", "試験導入"),
+    "導入推進中": ("導入推進", "全社展開"),
+    "定着期": ("定着",),
+}
+_STAGE_TAG_PATTERN = re.compile(r"\s*\[([^\]]+)\]")
+
+
+# 見出しに明示したステージのタプルを返す（タグがなければ空のタプル）
+def _tagged_stages(heading):
+    tags = _STAGE_TAG_PATTERN.findall(heading)
+    if SHARED_STAGE_TAG in tags:
+        return DX_STAGES
+    return tuple(stage for stage in DX_STAGES if stage in " ".join(tags))
+
+
+# 見出しからステージのタグを取り除く（ステージも「共通」も含まない [] はそのまま残す）
+def _strip_stage_tags(heading):
+    return _STAGE_TAG_PATTERN.sub(lambda match: "" if _tagged_stages(match.group(0)) else match.group(0), heading).strip()
+
+
+# チャンクが対象とするDX推進ステージのタプルを返す（空のタプルは全ステージ共通）
+# トピック → セクションの順にタグを探し、どちらにもなければキーワードで判定する
+def tag_stages(chunk):
+    for heading in (chunk["topic"], chunk["section"]):
+        stages = _tagged_stages(heading)
+        if stages:
+            return stages
+    for heading in (chunk["topic"], chunk["section"]):
+        stages = tuple(stage for stage in DX_STAGES if any(keyword in heading for keyword in STAGE_KEYWORDS[stage]))
+        if stages:
+            return stages
+    return ()
+
+
+# セクション行（「1. 導入時の論点」や Markdown の「# 見出し」）
+_SECTION_PATTERN = re.compile(r"^\s*(?:\d+[.．)）]|#{1,6})\s*(.+)$")
+
+
+# チェックリストを「セクション → トピック → 詳細」の階層で読み、トピック単位のチャンクに分ける
+# セクション行は「1. 導入時の論点」（Markdown では「# 見出し」）、トピックは「-」などで始まる箇条書きで、
+# トピックより深く字下げした行をその詳細として扱う（Markdown の入れ子の箇条書きと同じ書き方）
+# 見出しの末尾の「[導入前]」などのタグは対象のステージとして読み取り、見出しからは取り除く
+# 各チャンクは {"section", "topic", "details", "text", "source", "stages"} の辞書で、
+# text は親の文脈を含む検索・プロンプト用の文字列、source は読み込んだファイルのパス、
+# stages は対象のDX推進ステージ（空なら全ステージ共通）
+def chunk_checklist(text, source=""):
+    chunks = []
+    section = ""
+    current = None
+    topic_indent = 0
+
+    for raw_line in text.splitlines():
+        line = raw_line.strip()
+        if not line:
+            current = None
+            continue
+        match = _SECTION_PATTERN.match(line)
+        if match:
+            section = match.group(1).strip()
+            current = None
+            continue
+
+        expanded = raw_line.expandtabs(4)
+        indent = len(expanded) - len(expanded.lstrip())
+        content = line.lstrip("-・*").strip()
+        # トピックと同じかそれより浅い字下げの箇条書きは、次のトピックの始まり
+        if current is None or (line.startswith(("-", "・", "*")) and indent <= topic_indent):
+            current = {"section": section, "topic": content, "details": [], "source": source}
+            chunks.append(current)
+            topic_indent = indent
+        else:
+            current["details"].append(content)
+
+    for chunk in chunks:
+        # ステージのタグは判定にだけ使い、検索・プロンプト用の文字列には含めない
+        chunk["stages"] = tag_stages(chunk)
+        chunk["section"] = _strip_stage_tags(chunk["section"])
+        chunk["topic"] = _strip_stage_tags(chunk["topic"])
+        heading = f"【{chunk['section']}】{chunk['topic']}" if chunk["section"] else chunk["topic"]
+        chunk["text"] = f"{heading}: {' / '.join(chunk['details'])}" if chunk["details"] else heading
+    return chunks
+
+
+# ナレッジベースのファイルとして読み込む文字コード（先頭から順に試す）
+KNOWLEDGE_ENCODINGS = ("utf-8-sig", "cp932")
+
+
+# ファイルの内容を KNOWLEDGE_ENCODINGS の順に復号する（どれでも復号できなければ None）
+def _decode_text(data):
+    for encoding in KNOWLEDGE_ENCODINGS:
+        try:
+            return data.decode(encoding)
+        except UnicodeDecodeError:
+            continue
+    return None
+
+
+# 検索に使うインデックス一式。作り直すたびに新しいインスタンスを作り、KnowledgeBase.state への1回の代入で差し替える
+# 検索は読み始めた時点の state だけを使うため、差し替えの途中でも新旧のチャンクとインデックスが混ざらない
+class IndexState:
+    def __init__(self, version, chunks, index, stage_indexes, file_rows):
+        self.version = version  # 読み込んだ全ファイルの内容のハッシュ（インデックスのバージョンとして使う）
+        self.chunks = chunks  # 文書番号 -> チャンク（削除したチャンクは None）
+        self.index = index  # 全チャンクの BM25Index（文書番号は chunks と同じ）
+        self.stage_indexes = stage_indexes  # ステージ -> そのステージ向けと全ステージ共通のチャンクだけの BM25Index
+        self.file_rows = file_rows  # パス -> そのファイルのチャンクの文書番号のリスト
+        self.vector = None  # (VectorIndex, ステージ -> VectorIndex の行番号の配列)。初回のベクトル検索時に作る
+
+
+# チャンクが stage の検索対象か（そのステージ向けか、全ステージ共通）
+def _in_stage(chunk, stage):
+    return chunk is not None and (not chunk["stages"] or stage in chunk["stages"])
+
+
+# DX推進チェックリストと、ナレッジベース用ディレクトリ内の資料（.txt / .md）をまとめて検索するストア
+# ファイルごとに更新日時（mtime）と内容のハッシュを記録し、追加・変更されたファイルだけを読み込み直して
+# チャンクに分ける。変わったファイルのうち、テキストが変わったチャンクだけをインデックスから削除・追加し、
+# 埋め込みも変わったチャンクだけを計算するため、インデックスの更新にかかる時間は変更の大きさにおおむね比例する
+# Streamlit では st.cache_resource で1つのインスタンスを全セッションで共有する想定
+class KnowledgeBase:
+    def __init__(self, paths=(), directory=None, embedder=None, index_dir=DEFAULT_INDEX_DIR,
+                 refresh_interval=REFRESH_INTERVAL):
+        self.paths = list(paths)  # 個別に指定するファイル（dx_checklist.txt など）
+        self.directory = directory  # 資料を置くディレクトリ（None なら使わない）
+        self.embedder = embedder or create_embedder()  # ベクトル検索用の埋め込み（差し替え可能）
+        self.index_dir = index_dir  # 埋め込みの保存先（None または空文字列なら毎回メモリ上で計算する）
+        self.refresh_interval = refresh_interval  # ファイルの変更を確認する最短の間隔（秒）
+        self.files = {}  # パス -> {"mtime", "hash", "chunks"}
+        self.state = IndexState(None, [], BM25Index([]), {stage: BM25Index([]) for stage in DX_STAGES}, {})
+        self.search_cache = LRUCache()  # (正規化した質問, インデックスのバージョン, 検索条件) -> 検索結果
+        self._checked_at = None
+        self._lock = threading.Lock()
+
+    # 検索対象のファイルを列挙する（個別指定のファイル → ディレクトリ内のファイルの順）
+    def _list_files(self):
+        files = [path for path in self.paths if os.path.isfile(path)]
+        if self.directory and os.path.isdir(self.directory):
+            entries = sorted(os.scandir(self.directory), key=lambda entry: entry.name)
+            for entry in entries:
+                if entry.is_file() and entry.name.endswith(KNOWLEDGE_EXTENSIONS) and entry.path not in files:
+                    files.append(entry.path)
+        return files
+
+    # 追加・変更・削除されたファイルがあればインデックスを更新する
+    # 読み込めないファイル（列挙した後に削除されたものなど）は検索対象から外し、
+    # 復号できないファイルはチャンクなしとして記録する（ファイルが変わるまで読み直さない）
+    def refresh(self, force=False):
+        if not force and self._checked_at is not None and time.monotonic() - self._checked_at < self.refresh_interval:
+            return
+        with self._lock:
+            changed = {}  # パス -> 新しいチャンクのリスト（削除されたファイルは空のリスト）
+            paths = []
+            for path in self._list_files():
+                entry = self.files.get(path)
+                try:
+                    mtime = os.stat(path).st_mtime_ns
+                    if entry and entry["mtime"] == mtime:
+                        paths.append(path)
+                        continue
+                    with open(path, "rb") as file:
+                        data = file.read()
+                except OSError as error:
+                    _logger.warning("ナレッジベースのファイルを読み込めません: %s (%s)", path, error)
+                    continue
+                paths.append(path)
+                content_hash = hashlib.sha256(data).hexdigest()
+                if entry and entry["hash"] == content_hash:
+                    entry["mtime"] = mtime
+                    continue
+                text = _decode_text(data)
+                if text is None:
+                    _logger.warning("ナレッジベースのファイルの文字コードに対応していません（UTF-8 / Shift_JIS のみ）: %s", path)
+                    text = ""
+                self.files[path] = {
+                    "mtime": mtime,
+                    "hash": content_hash,
+                    "chunks": chunk_checklist(text, source=path),
+                }
+                changed[path] = self.files[path]["chunks"]
+
+            for path in set(self.files) - set(paths):
+                del self.files[path]
+                changed[path] = []
+
+            if changed or self.state.version is None:
+                self._build(paths, changed)
+            self._checked_at = time.monotonic()
+
+    # 変わったファイルのチャンクをインデックスに反映した新しい state を作り、1回の代入で差し替える
+    # テキストが同じチャンクは文書番号をそのまま使い、なくなったチャンクの削除と新しいチャンクの追加だけを行う
+    # ステージごとの索引も全体の索引と同じ文書番号で、そのステージのチャンクの分だけを削除・追加する
+    def _build(self, paths, changed):
+        state = self.state
+        chunks = list(state.chunks)
+        file_rows = dict(state.file_rows)
+        removed_ids = []
+        added_chunks = []
+        for path, new_chunks in changed.items():
+            unchanged = defaultdict(list)  # テキスト -> 変わっていないチャンクの文書番号
+            for row in file_rows.pop(path, []):
+                unchanged[chunks[row]["text"]].append(row)
+            rows = []
+            for chunk in new_chunks:
+                if unchanged[chunk["text"]]:
+                    rows.append(unchanged[chunk["text"]].pop(0))
+                else:
+                    rows.append(len(chunks) + len(added_chunks))
+                    added_chunks.append(chunk)
+            removed_ids.extend(row for remaining in unchanged.values() for row in remaining)
+            if rows:
+                file_rows[path] = rows
+
+        removed_counts = [char_ngrams(chunks[row]["text"], NGRAM_SIZES) for row in removed_ids]
+        for row in removed_ids:
+            chunks[row] = None
+        chunks.extend(added_chunks)
+        texts = [chunk["text"] for chunk in added_chunks]
+        added_counts = [char_ngrams(text, NGRAM_SIZES) for text in texts]
+        index = state.index.updated(removed_ids, removed_counts, texts, added_counts)
+        stage_indexes = {}
+        for stage, stage_index in state.stage_indexes.items():
+            removed = [i for i, row in enumerate(removed_ids) if stage_index.documents[row] is not None]
+            members = [_in_stage(chunk, stage) for chunk in added_chunks]
+            stage_indexes[stage] = stage_index.updated(
+                [removed_ids[i] for i in removed],
+                [removed_counts[i] for i in removed],
+                [text if member else None for text, member in zip(texts, members)],
+                [counts if member else {} for counts, member in zip(added_counts, members)],
+            )
+
+        # 削除したチャンクの空きが残りのチャンクより多くなったら、番号を詰めて作り直す
+        if index.removed_count > index.live_count:
+            compacted = []
+            for path in paths:
+                rows = file_rows.get(path, [])
+                file_rows[path] = list(range(len(compacted), len(compacted) + len(rows)))
+                compacted.extend(chunks[row] for row in rows)
+            chunks = compacted
+            counts = [char_ngrams(chunk["text"], NGRAM_SIZES) for chunk in chunks]
+            index = BM25Index([chunk["text"] for chunk in chunks], doc_counts=counts)
+            stage_indexes = {
+                stage: BM25Index(
+                    [chunk["text"] if _in_stage(chunk, stage) else None for chunk in chunks],
+                    doc_counts=[chunk_counts if _in_stage(chunk, stage) else {} for chunk, chunk_counts in zip(chunks, counts)],
+                )
+                for stage in DX_STAGES
+            }
+
+        version = hashlib.sha256(
+            "\n".join(f"{path}:{self.files[path]['hash']}" for path in paths).encode("utf-8")
+        ).hexdigest()
+        self.state = IndexState(version, chunks, index, stage_indexes, file_rows)
+        # インデックスを更新したので、古いバージョンの検索結果は使わない
+        self.search_cache.clear()
+
+    # state に対応するベクトル検索用のインデックスを返す（埋め込みの計算は初回のベクトル検索時に1度だけ行う）
+    # index_dir が指定されていれば、保存済みの埋め込みをメモリマップで開き、変わったチャンクだけを埋め込み直す
+    def _vector_index(self, state):
+        vector = state.vector
+        if vector is None:
+            with self._lock:
+                if state.vector is None:
+                    live_rows = np.array([i for i, chunk in enumerate(state.chunks) if chunk is not None], dtype=np.int32)
+                    live_chunks = [state.chunks[i] for i in live_rows]
+                    matrix = EmbeddingStore(self.index_dir, self.embedder).load(live_chunks) if self.index_dir else None
+                    index = VectorIndex([chunk["text"] for chunk in live_chunks], self.embedder, matrix)
+                    # 文書番号 -> VectorIndex の行番号
+                    positions = np.full(len(state.chunks), -1, dtype=np.int32)
+                    positions[live_rows] = np.arange(len(live_rows), dtype=np.int32)
+                    state.vector = (index, {
+                        stage: positions[[i for i, chunk in enumerate(state.chunks) if _in_stage(chunk, stage)]]
+                        for stage in DX_STAGES
+                    })
+                vector = state.vector
+        return vector
+
+    # 質問に関連するチャンク（親のセクション・トピックを含む文字列）を、関連度の高い順に最大 top_k 件返す
+    # mode が "bm25" の場合は min_score をBM25スコア、"vector" の場合はコサイン類似度の下限として扱う
+    # stage を指定すると、そのステージ向けのチャンクと全ステージ共通のチャンクだけを検索する
+    # 同じ質問・同じ条件の検索結果は、インデックスのバージョンが変わるまでLRUキャッシュから返す
+    def search(self, question, top_k=DEFAULT_TOP_K, min_score=None, mode=DEFAULT_RETRIEVAL_MODE, stage=None):
+        self.refresh()
+        state = self.state
+        key = (normalize_question(question), state.version, mode, stage, top_k, min_score)
+        cached = self.search_cache.get(key)
+        if cached is not None:
+            return list(cached)
+        results = self._search(state, question, top_k, min_score, mode, stage)
+        self.search_cache.put(key, tuple(results))
+        return results
+
+    def _search(self, state, question, top_k, min_score, mode, stage):
+        if mode == "vector":
+            index, stage_rows = self._vector_index(state)
+            min_score = DEFAULT_MIN_SIMILARITY if min_score is None else min_score
+            results = index.search(question, top_k, min_score, rows=stage_rows.get(stage))
+        else:
+            # ステージを指定した場合は、そのステージのチャンクだけのポスティングを足し合わせる
+            index = state.stage_indexes.get(stage, state.index)
+            min_score = DEFAULT_MIN_SCORE if min_score is None else min_score
+            results = index.search(question, top_k, min_score)
+        # そのステージに関連するチャンクがなければ、ステージで絞り込まずに検索し直す
+        if not results and stage is not None:
+            return self._search(state, question, top_k, min_score, mode, None)
+        return [index.documents[doc_id] for doc_id, _ in results]
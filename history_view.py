@@ -0,0 +1,47 @@
+import os
+
+import streamlit as st
+
+from message_log import newest_first_page
+
+# 履歴の1ページあたりの表示件数（環境変数 DX_HISTORY_PAGE_SIZE で変更可能）
+HISTORY_PAGE_SIZE = int(os.environ.get("DX_HISTORY_PAGE_SIZE", "10"))
+
+
+# 履歴のページを移動する（ボタンのコールバックから呼ばれ、次の再実行で表示するページが変わる）
+def move_history_page(state_key, step):
+    st.session_state[state_key] = max(0, st.session_state.get(state_key, 0) + step)
+
+
+# 履歴を新しい順に1ページ分だけ表示する（履歴全体ではなく、表示するページの分だけ描画する）
+# 閉じている間は何も描画せず、古いページは「古い履歴へ」を押したときに読み込む
+def render_history_page(label, items, state_key, render_item, skip=0):
+    if not st.checkbox(label, value=True, key=f"{state_key}_visible"):
+        return
+    page_items, page_count = newest_first_page(items, st.session_state.get(state_key, 0), HISTORY_PAGE_SIZE, skip)
+    page = min(st.session_state.get(state_key, 0), page_count - 1)
+    st.session_state[state_key] = page
+    for item in page_items:
+        render_item(item)
+    if page_count > 1:
+        newer_column, caption_column, older_column = st.columns(3)
+        newer_column.button("新しい履歴へ", key=f"{state_key}_newer", disabled=page == 0,
+                            on_click=move_history_page, args=(state_key, -1))
+        caption_column.caption(f"{page + 1} / {page_count} ページ")
+        older_column.button("古い履歴へ", key=f"{state_key}_older", disabled=page >= page_count - 1,
+                            on_click=move_history_page, args=(state_key, 1))
+
+
+# 会話履歴の1件を表示する
+def render_message(message):
+    speaker = "🙂" if message["role"] == "user" else "🤖"
+    st.write(f"{speaker}: {message['content']}")
+
+
+# チャット履歴（先頭のシステムプロンプトは表示しない）とフィードバック履歴を、それぞれ1ページ分だけ表示する
+def render_histories(messages, feedbacks=None):
+    if len(messages) > 1:
+        render_history_page("チャット履歴を表示", messages, "messages_page", render_message, skip=1)
+    if feedbacks:
+        st.write("📄 これまでのフィードバック履歴:")
+        render_history_page("フィードバック履歴を表示", feedbacks, "feedbacks_page", st.write)
@@ -0,0 +1,602 @@
+import contextlib
+import contextvars
+import hashlib
+import json
+import logging
+import os
+import queue
+import random
+import re
+import sqlite3
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import jsonschema
+import openai
+import requests
+from openai.util import convert_to_openai_object
+
+_logger = logging.getLogger(__name__)
+
+# LLM呼び出しの同時実行数の上限（環境変数 DX_LLM_MAX_WORKERS で変更可能）
+MAX_WORKERS = int(os.environ.get("DX_LLM_MAX_WORKERS", "5"))
+# LLMの応答キャッシュの保存先・有効期限（秒）・合計サイズの上限（バイト）
+# 保存先を空文字列にするとキャッシュを使わない
+RESPONSE_CACHE_PATH = os.environ.get("DX_LLM_CACHE_PATH", ".llm_cache.sqlite3")
+RESPONSE_CACHE_TTL = float(os.environ.get("DX_LLM_CACHE_TTL", str(7 * 24 * 60 * 60)))
+RESPONSE_CACHE_MAX_BYTES = int(os.environ.get("DX_LLM_CACHE_MAX_BYTES", str(50 * 1024 * 1024)))
+# OpenAI APIへの接続・応答の読み取りのタイムアウト（秒）と、接続プールで保持する接続数
+LLM_CONNECT_TIMEOUT = float(os.environ.get("DX_LLM_CONNECT_TIMEOUT", "10"))
+LLM_READ_TIMEOUT = float(os.environ.get("DX_LLM_READ_TIMEOUT", "120"))
+LLM_POOL_SIZE = int(os.environ.get("DX_LLM_POOL_SIZE", str(MAX_WORKERS * 4)))
+# アカウントのレート制限（1分あたりのリクエスト数・トークン数）。0 にすると制限しない
+LLM_RPM_LIMIT = int(os.environ.get("DX_LLM_RPM", "500"))
+LLM_TPM_LIMIT = int(os.environ.get("DX_LLM_TPM", "200000"))
+# 429・5xx エラー時の再試行回数と、待ち時間（秒）の初期値・上限
+LLM_MAX_RETRIES = int(os.environ.get("DX_LLM_MAX_RETRIES", "5"))
+LLM_BACKOFF_BASE = float(os.environ.get("DX_LLM_BACKOFF_BASE", "1"))
+LLM_BACKOFF_MAX = float(os.environ.get("DX_LLM_BACKOFF_MAX", "60"))
+
+
+# openai ライブラリは一定時間ごとにスレッドのセッションを close するが、
+# プロセス内で共有するセッションは閉じずに使い続ける
+class _SharedSession(requests.Session):
+    def close(self):
+        pass
+
+
+_http_session = None
+_http_session_lock = threading.Lock()
+
+
+# APIキーを設定し、プロセス内で共有するHTTPセッション（keep-alive の接続プール）を openai ライブラリに使わせる
+# Streamlitの再実行やセッション、ワーカースレッドをまたいで接続を再利用し、リクエストごとのTLS接続を避ける
+def init_openai(api_key):
+    global _http_session
+    openai.api_key = api_key
+    with _http_session_lock:
+        if _http_session is None:
+            session = _SharedSession()
+            adapter = requests.adapters.HTTPAdapter(pool_maxsize=LLM_POOL_SIZE, max_retries=2)
+            session.mount("https://", adapter)
+            _http_session = session
+    openai.requestssession = _http_session
+
+
+# 1分あたり rate_per_minute 個ずつ補充され、最大 capacity 個まで貯まるトークンバケット
+# capacity を省略した場合は10秒分（一度に流せる量をアカウントの制限の粒度に合わせる）
+class TokenBucket:
+    def __init__(self, rate_per_minute, capacity=None):
+        self.rate = rate_per_minute / 60
+        self.capacity = capacity or max(1.0, rate_per_minute / 6)
+        self.tokens = self.capacity
+        self.updated_at = time.monotonic()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    # amount 個を取り出せるようになるまでの待ち時間（秒）。capacity を超える分は capacity として扱う
+    def wait_time(self, amount, now):
+        self._refill(now)
+        amount = min(amount, self.capacity)
+        return 0.0 if self.tokens >= amount else (amount - self.tokens) / self.rate
+
+    # amount 個を取り出す（見積もりとの差を精算する場合は負の値で戻し、不足分は借りとして残す）
+    def take(self, amount, now):
+        self._refill(now)
+        self.tokens -= min(amount, self.capacity)
+
+
+# 全セッションのLLM呼び出しの開始を、1分あたりのリクエスト数・トークン数の範囲に収めるスケジューラ
+# 待っている呼び出しはセッション（owner）ごとに並べ、セッションを順番に1件ずつ通すことで、
+# 一度に多数の呼び出しを発行したセッションが他のセッションを待たせ続けないようにする
+class RequestScheduler:
+    def __init__(self, rpm=LLM_RPM_LIMIT, tpm=LLM_TPM_LIMIT):
+        self.request_bucket = TokenBucket(rpm) if rpm > 0 else None
+        self.token_bucket = TokenBucket(tpm) if tpm > 0 else None
+        self.blocked_until = 0.0
+        self._queues = {}
+        self._order = deque()
+        self._condition = threading.Condition()
+
+    def _wait_time(self, tokens, now):
+        wait = self.blocked_until - now
+        if self.request_bucket is not None:
+            wait = max(wait, self.request_bucket.wait_time(1, now))
+        if self.token_bucket is not None:
+            wait = max(wait, self.token_bucket.wait_time(tokens, now))
+        return wait
+
+    # 呼び出しを開始してよくなるまで待ち、リクエスト1件とトークン tokens 個を消費する
+    def acquire(self, tokens, owner=None):
+        ticket = object()
+        with self._condition:
+            if owner not in self._queues:
+                self._queues[owner] = deque()
+                self._order.append(owner)
+            self._queues[owner].append(ticket)
+            while True:
+                if self._order[0] != owner or self._queues[owner][0] is not ticket:
+                    self._condition.wait()
+                    continue
+                now = time.monotonic()
+                wait = self._wait_time(tokens, now)
+                if wait > 0:
+                    self._condition.wait(wait)
+                    continue
+
+                if self.request_bucket is not None:
+                    self.request_bucket.take(1, now)
+                if self.token_bucket is not None:
+                    self.token_bucket.take(tokens, now)
+                # 同じセッションの次の呼び出しは、他のセッションの後ろに回す
+                self._queues[owner].popleft()
+                self._order.popleft()
+                if self._queues[owner]:
+                    self._order.append(owner)
+                else:
+                    del self._queues[owner]
+                self._condition.notify_all()
+                return
+
+    # 実際に消費したトークン数が分かったら、見積もりとの差をバケットで精算する
+    def settle(self, estimated_tokens, used_tokens):
+        if self.token_bucket is not None:
+            with self._condition:
+                self.token_bucket.take(used_tokens - estimated_tokens, time.monotonic())
+                self._condition.notify_all()
+
+    # レート制限に達した（429）場合、全セッションの呼び出しの開始を seconds 秒止める
+    def pause(self, seconds):
+        with self._condition:
+            self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+            self._condition.notify_all()
+
+
+_scheduler = RequestScheduler()
+# 呼び出し元のセッションを表す値（run_concurrently のワーカースレッドにも引き継ぐ）
+_request_owner = contextvars.ContextVar("request_owner", default=None)
+
+
+# 以降のLLM呼び出しを、どのセッションからの呼び出しとしてスケジューラに並べるかを設定する
+def set_request_owner(owner):
+    _request_owner.set(owner)
+
+
+# テキストのトークン数の見積もり（日本語などはおおむね1文字1トークン、英数字は約4文字で1トークン）
+def count_tokens(text):
+    text = str(text or "")
+    ascii_count = sum(1 for char in text if char.isascii())
+    return (len(text) - ascii_count) + (ascii_count + 3) // 4
+
+
+# メッセージのリストのトークン数の見積もり（メッセージごとの区切りの分として4トークンを加える）
+def count_message_tokens(messages):
+    return sum(count_tokens(message.get("content")) + 4 for message in messages)
+
+
+# テキストを max_tokens トークン以内に収まるよう末尾を切り詰める
+def truncate_to_tokens(text, max_tokens):
+    if count_tokens(text) <= max_tokens:
+        return text
+    used = 0
+    ascii_run = 0
+    for index, char in enumerate(text):
+        if char.isascii():
+            ascii_run += 1
+            cost = 1 if ascii_run % 4 == 1 else 0
+        else:
+            cost = 1
+        if used + cost > max_tokens - 1:
+            return text[:index] + "…"
+        used += cost
+    return text
+
+
+# リクエストが消費するトークン数の見積もり（メッセージのトークン数に応答の上限 max_tokens を加える）
+def estimate_request_tokens(request):
+    return count_message_tokens(request.get("messages", [])) + (request.get("max_tokens") or 1000)
+
+
+# 429・5xx のエラーなら再試行するまでの待ち時間（秒）を返す（再試行しないエラーなら None）
+# Retry-After ヘッダーがあればそれに従い、なければ指数的に延ばした待ち時間にランダムな揺らぎを加える
+def _retry_delay(error, attempt):
+    status = getattr(error, "http_status", None) or 0
+    if not isinstance(error, (openai.error.RateLimitError, openai.error.ServiceUnavailableError)) and status < 500:
+        return None
+    headers = getattr(error, "headers", None) or {}
+    retry_after = headers.get("retry-after") or headers.get("Retry-After")
+    try:
+        if retry_after is not None:
+            return float(retry_after) + random.uniform(0, LLM_BACKOFF_BASE)
+    except ValueError:
+        pass
+    return random.uniform(0, min(LLM_BACKOFF_MAX, LLM_BACKOFF_BASE * 2 ** attempt))
+
+
+# スケジューラの許可を得てから呼び出し、429・5xx のエラーは LLM_MAX_RETRIES 回まで再試行する
+def _call_with_retry(create, tokens, **request):
+    request.setdefault("request_timeout", (LLM_CONNECT_TIMEOUT, LLM_READ_TIMEOUT))
+    owner = _request_owner.get()
+    for attempt in range(LLM_MAX_RETRIES + 1):
+        _scheduler.acquire(tokens, owner)
+        try:
+            return create(**request)
+        except openai.error.OpenAIError as e:
+            delay = _retry_delay(e, attempt)
+            if delay is None or attempt == LLM_MAX_RETRIES:
+                raise
+            if isinstance(e, openai.error.RateLimitError):
+                _scheduler.pause(delay)
+            time.sleep(delay)
+
+
+# openai.ChatCompletion.create を呼び出す共通の関数
+# 接続・読み取りのタイムアウトを必ず指定し、レート制限の範囲で呼び出して 429・5xx は再試行する
+def call_chat_completion(**request):
+    tokens = estimate_request_tokens(request)
+    response = _call_with_retry(openai.ChatCompletion.create, tokens, **request)
+    # ストリーミングでない場合は、応答に含まれる実際の使用トークン数で見積もりを精算する
+    usage = None if request.get("stream") else response.get("usage")
+    if usage:
+        _scheduler.settle(tokens, usage["total_tokens"])
+    return response
+
+
+# openai.Embedding.create を呼び出す共通の関数（タイムアウト・レート制限・再試行は call_chat_completion と同じ）
+def call_embedding(**request):
+    tokens = sum(len(str(text)) for text in request.get("input", []))
+    return _call_with_retry(openai.Embedding.create, tokens, **request)
+
+
+# 複数のタスクをスレッドプールで同時に実行し、完了した順に結果を返す
+# tasks は {キー: 引数なしの関数} の辞書。例外はタスクごとに捕捉し (キー, None, 例外) として返す
+# ※ Streamlit の描画はワーカースレッドから行えないため、呼び出し側（メインスレッド）で行うこと
+def run_concurrently(tasks, max_workers=None):
+    if not tasks:
+        return
+    max_workers = max(1, min(max_workers or MAX_WORKERS, len(tasks)))
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        # 呼び出し元のセッション（set_request_owner）をワーカースレッドに引き継ぐ
+        futures = {executor.submit(contextvars.copy_context().run, func): key for key, func in tasks.items()}
+        for future in as_completed(futures):
+            key = futures[future]
+            try:
+                yield key, future.result(), None
+            except Exception as e:
+                yield key, None, e
+
+
+# run_concurrently と同様にタスクを同時に実行し、ストリーミングの途中経過も受け取った順に返す
+# tasks の関数は引数 on_delta を受け取り、ワーカースレッドから on_delta(*値) で途中経過を送る
+# 途中経過は ("delta", キー, 値のタプル, None)、完了は ("done", キー, 結果, 例外) として返す
+def run_concurrently_streaming(tasks, max_workers=None):
+    if not tasks:
+        return
+    events = queue.Queue()
+
+    def run(key, func):
+        try:
+            result = func(lambda *value: events.put(("delta", key, value, None)))
+            events.put(("done", key, result, None))
+        except Exception as e:
+            events.put(("done", key, None, e))
+
+    max_workers = max(1, min(max_workers or MAX_WORKERS, len(tasks)))
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for key, func in tasks.items():
+            executor.submit(contextvars.copy_context().run, run, key, func)
+        remaining = len(tasks)
+        while remaining:
+            event = events.get()
+            if event[0] == "done":
+                remaining -= 1
+            yield event
+
+
+# 質問抽出で見出し・ラベルとして扱う文字列（「**質問:**」「### 質問」など）
+QUESTION_LABELS = ("質問", "問い", "Question", "Q")
+# 質問として扱う行の末尾（「〜を教えてください。」のような依頼の形も質問に含める）
+QUESTION_ENDINGS = ("?", "？", "か", "でしょうか", "ますか", "ですか", "ください")
+# 前置き（「以下は〜についての質問です。」「次の質問に答えます」など）として扱う行の先頭と末尾
+PREAMBLE_PREFIXES = ("以下", "次の")
+PREAMBLE_ENDINGS = ("質問です", "質問になります", "質問を挙げます")
+
+_BULLET_PATTERN = re.compile(r"^\s*(?:[-*・●■◆>#]+|\d+[.)）．、]|[（(]\d+[)）]|[①-⑳])\s*")
+_LABEL_PATTERN = re.compile(
+    r"^(?:" + "|".join(QUESTION_LABELS) + r")\s*\d*\s*[:：]\s*", re.IGNORECASE
+)
+
+
+# 1行から箇条書き記号・強調記号・「質問:」などのラベルを取り除く
+def _clean_question_line(line):
+    line = line.strip()
+    line = _BULLET_PATTERN.sub("", line)
+    line = line.replace("**", "").replace("__", "").strip()
+    line = _LABEL_PATTERN.sub("", line)
+    return line.strip(" 「」\"'")
+
+
+# LLMの出力テキストから実際の質問文だけを抽出する
+# 空行・見出し・前置き（「以下は〜の質問です。」など）は除外し、重複も取り除く
+# 疑問形の行が1つもない場合は、最も長い本文行を1件だけ質問として扱う
+def extract_questions(text, max_questions=None):
+    candidates = []
+    for raw_line in (text or "").splitlines():
+        line = _clean_question_line(raw_line)
+        # 空行・ラベルだけの行・「〜:」で終わる見出し行は質問ではない
+        if not line or line.endswith((":", "：")) or line in QUESTION_LABELS:
+            continue
+        # 「〜の質問です。」で終わる行や、疑問形でない「以下は〜」「次の〜」で始まる行は、質問を紹介する前置き
+        # （「次のフェーズに進むには〜でしょうか？」のように疑問形で終わる行は質問として残す）
+        ending = line.rstrip("。.!！")
+        if ending.endswith(PREAMBLE_ENDINGS) or (line.startswith(PREAMBLE_PREFIXES) and not ending.endswith(QUESTION_ENDINGS)):
+            continue
+        if line not in candidates:
+            candidates.append(line)
+
+    questions = [line for line in candidates if line.rstrip("。.!！").endswith(QUESTION_ENDINGS)]
+    if not questions and candidates:
+        questions = [max(candidates, key=len)]
+    return questions[:max_questions] if max_questions else questions
+
+
+# 全カテゴリの質問をまとめて生成したJSON出力のスキーマ
+# 例: {"組織課題": ["…ですか？"], "技術課題": ["…でしょうか？"], ...}
+def build_category_questions_schema(categories):
+    return {
+        "type": "object",
+        "properties": {
+            category: {
+                "type": "array",
+                "items": {"type": "string", "minLength": 1},
+                "minItems": 1,
+            }
+            for category in categories
+        },
+        "required": list(categories),
+    }
+
+
+# JSON出力をスキーマで検証し、{カテゴリ: [質問, ...]} を返す
+# JSONとして読めない・スキーマに合わない場合は ValueError を送出する
+def parse_category_questions(text, categories):
+    try:
+        data = json.loads(text)
+        jsonschema.validate(data, build_category_questions_schema(categories))
+    except (json.JSONDecodeError, jsonschema.ValidationError) as e:
+        raise ValueError(f"質問のJSON出力が不正です: {getattr(e, 'message', e)}") from e
+
+    questions_by_category = {}
+    for category in categories:
+        questions = []
+        for item in data[category]:
+            questions.extend(extract_questions(item))
+        if not questions:
+            raise ValueError(f"質問のJSON出力に {category} の質問が含まれていません")
+        questions_by_category[category] = questions
+    return questions_by_category
+
+
+# 回答をまとめて生成する際の1リクエストあたりの質問数（環境変数 DX_ANSWER_BATCH_SIZE で変更可能）
+ANSWER_BATCH_SIZE = int(os.environ.get("DX_ANSWER_BATCH_SIZE", "3"))
+
+
+# 複数の質問への回答をまとめて生成したJSON出力のスキーマ
+# 例: {"answers": ["1つ目の質問への回答", "2つ目の質問への回答", ...]}
+def build_batch_answers_schema(count):
+    return {
+        "type": "object",
+        "properties": {
+            "answers": {
+                "type": "array",
+                "items": {"type": "string", "minLength": 1},
+                "minItems": count,
+                "maxItems": count,
+            }
+        },
+        "required": ["answers"],
+    }
+
+
+# JSON出力をスキーマで検証し、質問と同じ順序の回答リストを返す
+# JSONとして読めない・件数が合わない場合は ValueError を送出する
+def parse_batch_answers(text, count):
+    try:
+        data = json.loads(text)
+        jsonschema.validate(data, build_batch_answers_schema(count))
+    except (json.JSONDecodeError, jsonschema.ValidationError) as e:
+        raise ValueError(f"回答のJSON出力が不正です: {getattr(e, 'message', e)}") from e
+    return [answer.strip() for answer in data["answers"]]
+
+
+# リストを size 件ずつに分割する
+def split_into_batches(items, size):
+    size = max(1, size)
+    return [items[i:i + size] for i in range(0, len(items), size)]
+
+
+# LLMの応答を SQLite に保存するキャッシュ
+# キーはリクエスト内容（モデル・メッセージ・temperature・top_p・max_tokens など）のハッシュで、
+# 有効期限切れの応答は使わず、合計サイズが上限を超えたら最後に使われた時刻が古いものから削除する
+# 操作ごとに接続を開いて閉じるため、スレッドや複数のプロセスから同時に使える
+class ResponseCache:
+    def __init__(self, path=RESPONSE_CACHE_PATH, ttl=RESPONSE_CACHE_TTL, max_bytes=RESPONSE_CACHE_MAX_BYTES):
+        self.path = path
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        with self._connect() as connection:
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute(
+                """
+                CREATE TABLE IF NOT EXISTS responses (
+                    key TEXT PRIMARY KEY,
+                    response TEXT NOT NULL,
+                    size INTEGER NOT NULL,
+                    created_at REAL NOT NULL,
+                    accessed_at REAL NOT NULL
+                )
+                """
+            )
+
+    # 接続を開き、ブロックを抜けるときにコミット（例外時はロールバック）してから閉じる
+    @contextlib.contextmanager
+    def _connect(self):
+        with contextlib.closing(sqlite3.connect(self.path, timeout=10)) as connection:
+            with connection:
+                yield connection
+
+    # リクエスト内容からキャッシュのキーを作る
+    @staticmethod
+    def make_key(**request):
+        payload = json.dumps(request, ensure_ascii=False, sort_keys=True, default=str)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    # 有効期限内の応答があれば辞書で返す（なければ None）
+    def get(self, key):
+        now = time.time()
+        with self._connect() as connection:
+            row = connection.execute(
+                "SELECT response FROM responses WHERE key = ? AND created_at >= ?", (key, now - self.ttl)
+            ).fetchone()
+            if row is None:
+                return None
+            connection.execute("UPDATE responses SET accessed_at = ? WHERE key = ?", (now, key))
+        return json.loads(row[0])
+
+    # 応答を保存し、期限切れの応答とサイズの上限を超えた分を削除する
+    def put(self, key, response):
+        now = time.time()
+        data = json.dumps(response, ensure_ascii=False)
+        with self._connect() as connection:
+            connection.execute(
+                "INSERT OR REPLACE INTO responses (key, response, size, created_at, accessed_at) VALUES (?, ?, ?, ?, ?)",
+                (key, data, len(data.encode("utf-8")), now, now),
+            )
+            connection.execute("DELETE FROM responses WHERE created_at < ?", (now - self.ttl,))
+            connection.execute(
+                """
+                DELETE FROM responses WHERE key IN (
+                    SELECT key FROM (
+                        SELECT key, SUM(size) OVER (ORDER BY accessed_at DESC, key) AS total FROM responses
+                    ) WHERE total > ?
+                )
+                """,
+                (self.max_bytes,),
+            )
+
+    def clear(self):
+        with self._connect() as connection:
+            connection.execute("DELETE FROM responses")
+
+
+_response_cache = None
+_response_cache_disabled = False
+_response_cache_lock = threading.Lock()
+
+
+# プロセス内で共有する応答キャッシュを返す（保存先が空文字列ならキャッシュを使わない）
+# 保存先を開けない場合（書き込めないパスなど）は警告を記録し、以降はキャッシュなしで動かす
+def get_response_cache():
+    global _response_cache, _response_cache_disabled
+    if _response_cache is None and RESPONSE_CACHE_PATH and not _response_cache_disabled:
+        with _response_cache_lock:
+            if _response_cache is None and not _response_cache_disabled:
+                try:
+                    _response_cache = ResponseCache()
+                except sqlite3.Error as error:
+                    _logger.warning("LLMの応答キャッシュを開けないため、キャッシュを使わずに実行します: %s (%s)", RESPONSE_CACHE_PATH, error)
+                    _response_cache_disabled = True
+    return _response_cache
+
+
+# stream=True で応答を受信し、届いた断片ごとに on_delta(断片) を呼び出す
+# 受信し終えた内容は、stream を指定しない場合と同じ形の応答（辞書）にまとめて返す
+# 受信の途中で接続が切れた場合の requests の例外は、呼び出し側で扱えるよう openai.error.APIConnectionError にする
+def _stream_chat_completion(on_delta, **request):
+    contents = []
+    finish_reason = None
+    try:
+        for chunk in call_chat_completion(stream=True, **request):
+            choice = chunk["choices"][0]
+            delta = choice["delta"].get("content")
+            if delta:
+                contents.append(delta)
+                on_delta(delta)
+            finish_reason = choice.get("finish_reason") or finish_reason
+    except requests.RequestException as error:
+        raise openai.error.APIConnectionError(f"応答の受信中に接続が切れました: {error}") from error
+    return {
+        "object": "chat.completion",
+        "model": request.get("model"),
+        "choices": [
+            {
+                "index": 0,
+                "message": {"role": "assistant", "content": "".join(contents)},
+                "finish_reason": finish_reason,
+            }
+        ],
+    }
+
+
+# call_chat_completion の代わりに使う関数。同じリクエストの応答はキャッシュから返す
+# サンプリングの多様性が必要な呼び出し（同じ条件で別の結果が欲しい場合など）では use_cache=False を指定する
+# on_delta を指定するとストリーミングで受信し、届いた断片ごとに on_delta(断片) を呼び出す
+# （キャッシュから返す場合は全文を1回で渡す）。戻り値はどちらの場合も同じ形の応答
+# キャッシュの読み書きに失敗した場合は警告を記録し、キャッシュを使わなかったものとして続ける
+def create_chat_completion(use_cache=True, on_delta=None, **request):
+    cache = get_response_cache() if use_cache else None
+    key = ResponseCache.make_key(**request) if cache is not None else None
+    cached = None
+    if cache is not None:
+        try:
+            cached = cache.get(key)
+        except sqlite3.Error as error:
+            _logger.warning("LLMの応答キャッシュを読み込めません: %s", error)
+    if cached is not None:
+        response = convert_to_openai_object(cached)
+        if on_delta is not None:
+            on_delta(response["choices"][0]["message"]["content"])
+        return response
+
+    if on_delta is None:
+        response = call_chat_completion(**request)
+        data = response.to_dict_recursive() if hasattr(response, "to_dict_recursive") else response
+    else:
+        data = _stream_chat_completion(on_delta, **request)
+        response = convert_to_openai_object(data)
+
+    if cache is not None:
+        try:
+            cache.put(key, data)
+        except sqlite3.Error as error:
+            _logger.warning("LLMの応答キャッシュに保存できません: %s", error)
+    return response
+
+
+# extract_questions の入力と期待する出力の例（`python llm_utils.py` で確認する）
+# 抽出した質問ごとにLLMへの回答リクエストを発行するため、前置きの除外と質問の取りこぼしの両方を確かめる
+_EXTRACT_QUESTIONS_EXAMPLES = (
+    ("以下は、導入前の段階における組織の壁についての質問です。\n\n経営層の理解を得る方法を教えてください。",
+     ["経営層の理解を得る方法を教えてください。"]),
+    ("次のフェーズに進むために、現場の抵抗をどう乗り越えるべきでしょうか？",
+     ["次のフェーズに進むために、現場の抵抗をどう乗り越えるべきでしょうか？"]),
+    ("以下の課題を踏まえて、どの業務から着手すべきでしょうか？",
+     ["以下の課題を踏まえて、どの業務から着手すべきでしょうか？"]),
+    ("以下の3つの質問を考えました。\n1. 予算はどう確保しますか？\n2. **質問:** 研修の進め方を教えてください",
+     ["予算はどう確保しますか？", "研修の進め方を教えてください"]),
+    ("次の質問です\n- 成果をどう測ればよいですか？\n- 成果をどう測ればよいですか？",
+     ["成果をどう測ればよいですか？"]),
+    ("### 質問\n現場の巻き込み方に悩んでいます", ["現場の巻き込み方に悩んでいます"]),
+    ("", []),
+)
+
+
+if __name__ == "__main__":
+    for text, expected in _EXTRACT_QUESTIONS_EXAMPLES:
+        actual = extract_questions(text)
+        assert actual == expected, f"extract_questions({text!r}) -> {actual!r}（期待: {expected!r}）"
+    print(f"extract_questions: {len(_EXTRACT_QUESTIONS_EXAMPLES)}件の例がすべて一致しました")
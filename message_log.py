@@ -0,0 +1,198 @@
+import hashlib
+import json
+import os
+import sys
+import zlib
+from collections.abc import Mapping, MutableSequence
+
+# 圧縮せずに保持する直近のメッセージ数（環境変数 DX_MESSAGE_ARCHIVE_AFTER で指定。0 なら圧縮しない）
+MESSAGE_ARCHIVE_AFTER = int(os.environ.get("DX_MESSAGE_ARCHIVE_AFTER", "0"))
+
+
+# 会話履歴の1件（役割と内容だけを持つ軽量なレコード）
+# 辞書と同じく message["role"]・message.get("content") で読め、pd.DataFrame にもそのまま渡せる
+# 役割と、全セッションで同じになるシステムプロンプトは intern して1つの文字列を共有する
+class Message(Mapping):
+    __slots__ = ("role", "content")
+    _fields = ("role", "content")
+
+    def __init__(self, role, content):
+        self.role = sys.intern(role)
+        self.content = sys.intern(content) if role == "system" and isinstance(content, str) else content
+
+    @classmethod
+    def from_mapping(cls, message):
+        if isinstance(message, cls):
+            return message
+        return cls(message["role"], message["content"])
+
+    def __getitem__(self, key):
+        if key not in self._fields:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def __iter__(self):
+        return iter(self._fields)
+
+    def __len__(self):
+        return len(self._fields)
+
+    def __repr__(self):
+        return f"Message(role={self.role!r}, content={self.content!r})"
+
+
+def _content_key(content):
+    return hashlib.blake2b(str(content).encode("utf-8"), digest_size=8).digest()
+
+
+# 会話履歴（st.session_state["messages"]）のリスト
+# 通常のリストと同じく表示・Excel出力（pd.DataFrame）に使え、内容のハッシュごとの件数の索引を合わせて持つため、
+# 同じ内容のメッセージがあるかを定数時間で調べられる
+# archive_after を指定すると、直近 archive_after 件より古いメッセージをまとめて圧縮して保持する
+# （圧縮したメッセージも読み出せるが、読み出すたびに展開するため、表示は直近の分だけにすること）
+class MessageLog(MutableSequence):
+    def __init__(self, messages=(), archive_after=MESSAGE_ARCHIVE_AFTER):
+        self.archive_after = archive_after
+        self._archive = []  # [(件数, 圧縮したJSON), ...]（古い順）
+        self._archived_count = 0
+        self._live = []
+        self._content_counts = {}
+        self._cached_block = (None, None)
+        self.extend(messages)
+
+    def _index(self, message):
+        key = _content_key(message["content"])
+        self._content_counts[key] = self._content_counts.get(key, 0) + 1
+
+    def _unindex(self, message):
+        key = _content_key(message["content"])
+        count = self._content_counts.get(key, 0) - 1
+        if count > 0:
+            self._content_counts[key] = count
+        else:
+            self._content_counts.pop(key, None)
+
+    # 同じ内容のメッセージが既にあるか
+    def has_content(self, content):
+        return _content_key(content) in self._content_counts
+
+    # 直近 archive_after 件より古いメッセージを1つのブロックに圧縮する（直近の件数の2倍を超えたらまとめて行う）
+    def _archive_old_messages(self):
+        if self.archive_after <= 0 or len(self._live) <= self.archive_after * 2:
+            return
+        count = len(self._live) - self.archive_after
+        data = json.dumps([[message.role, message.content] for message in self._live[:count]], ensure_ascii=False)
+        self._archive.append((count, zlib.compress(data.encode("utf-8"))))
+        self._archived_count += count
+        del self._live[:count]
+
+    def _load_block(self, block_index):
+        if self._cached_block[0] != block_index:
+            data = zlib.decompress(self._archive[block_index][1]).decode("utf-8")
+            self._cached_block = (block_index, [Message(role, content) for role, content in json.loads(data)])
+        return self._cached_block[1]
+
+    # 圧縮したメッセージをすべて展開して戻す（先頭付近を書き換える場合に使う）
+    def _restore(self):
+        if self._archive:
+            restored = []
+            for block_index in range(len(self._archive)):
+                restored.extend(self._load_block(block_index))
+            self._live = restored + self._live
+            self._archive = []
+            self._archived_count = 0
+            self._cached_block = (None, None)
+
+    def _get(self, index):
+        if index >= self._archived_count:
+            return self._live[index - self._archived_count]
+        for block_index, (count, _) in enumerate(self._archive):
+            if index < count:
+                return self._load_block(block_index)[index]
+            index -= count
+
+    def __len__(self):
+        return self._archived_count + len(self._live)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self._get(i) for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("message index out of range")
+        return self._get(index)
+
+    def __iter__(self):
+        for block_index in range(len(self._archive)):
+            yield from self._load_block(block_index)
+        yield from list(self._live)
+
+    def append(self, message):
+        message = Message.from_mapping(message)
+        self._live.append(message)
+        self._index(message)
+        self._archive_old_messages()
+
+    def insert(self, index, message):
+        self._restore()
+        message = Message.from_mapping(message)
+        self._live.insert(index, message)
+        self._index(message)
+
+    def __setitem__(self, index, value):
+        self._restore()
+        if isinstance(index, slice):
+            removed, added = self._live[index], [Message.from_mapping(message) for message in value]
+            self._live[index] = added
+        else:
+            removed, added = [self._live[index]], [Message.from_mapping(value)]
+            self._live[index] = added[0]
+        for message in removed:
+            self._unindex(message)
+        for message in added:
+            self._index(message)
+
+    def __delitem__(self, index):
+        self._restore()
+        removed = self._live[index] if isinstance(index, slice) else [self._live[index]]
+        del self._live[index]
+        for message in removed:
+            self._unindex(message)
+
+    def clear(self):
+        self._archive = []
+        self._archived_count = 0
+        self._live = []
+        self._content_counts = {}
+        self._cached_block = (None, None)
+
+    # このセッションの会話履歴が使っているメモリの概算（バイト）
+    # intern した文字列（システムプロンプトなど）は全セッションで共有するため数えない
+    def memory_stats(self):
+        live_bytes = sys.getsizeof(self._live) + sum(
+            sys.getsizeof(message) + (0 if message.role == "system" else sys.getsizeof(message.content))
+            for message in self._live
+        )
+        archive_bytes = sum(len(data) for _, data in self._archive)
+        index_bytes = sys.getsizeof(self._content_counts) + sum(sys.getsizeof(key) for key in self._content_counts)
+        return {
+            "messages": len(self),
+            "live_messages": len(self._live),
+            "archived_messages": self._archived_count,
+            "live_bytes": live_bytes,
+            "archive_bytes": archive_bytes,
+            "index_bytes": index_bytes,
+            "total_bytes": live_bytes + archive_bytes + index_bytes,
+        }
+
+
+# 履歴を新しい順に page_size 件ずつに分けたときの page ページ目（0始まり）の項目と、ページ数を返す
+# 先頭の skip 件（システムプロンプトなど）は含めず、表示するページの分だけを取り出す
+def newest_first_page(items, page, page_size, skip=0):
+    total = max(0, len(items) - skip)
+    page_count = max(1, -(-total // page_size))
+    page = min(max(page, 0), page_count - 1)
+    end = len(items) - page * page_size
+    start = max(skip, end - page_size)
+    return list(reversed(items[start:end])), page_count
@@ -0,0 +1,72 @@
+import copy
+import hashlib
+import json
+import os
+import threading
+import time
+
+# ペルソナの実行結果を保存するディレクトリ（環境変数 DX_RUN_STORE_DIR で指定。空ならプロセス内のメモリだけに保持）
+RUN_STORE_DIR = os.environ.get("DX_RUN_STORE_DIR", "")
+
+
+# ペルソナごとの実行結果（カテゴリごとの質問と回答、フィードバック）を全セッションで共有するストア
+# キーは (ペルソナID, DX推進ステージ, アプリの種類)。directory を指定するとJSONファイルにも保存し、
+# プロセスを再起動しても前回の結果を読み込める
+# 実行結果は {"results": {カテゴリ: [[質問, 回答], ...]}, "feedbacks": [...], "updated_at": 時刻} の辞書
+class PersonaRunStore:
+    def __init__(self, directory=RUN_STORE_DIR):
+        self.directory = directory
+        self._runs = {}
+        self._lock = threading.Lock()
+
+    def _path(self, key):
+        name = hashlib.sha256(json.dumps(key, ensure_ascii=False).encode("utf-8")).hexdigest()[:32]
+        return os.path.join(self.directory, f"{name}.json")
+
+    # メモリになければファイルから読み込む（なければ None）。ロックを取得した状態で呼び出すこと
+    def _load(self, key):
+        run = self._runs.get(key)
+        if run is None and self.directory:
+            try:
+                with open(self._path(key), "r", encoding="utf-8") as file:
+                    run = json.load(file)
+                self._runs[key] = run
+            except (OSError, ValueError):
+                run = None
+        return run
+
+    # 保存済みの実行結果を返す（なければ None）。呼び出し側で変更しても影響しないようコピーを返す
+    def get(self, persona_id, stage, variant):
+        with self._lock:
+            return copy.deepcopy(self._load((persona_id, stage, variant)))
+
+    def _write(self, key, run):
+        self._runs[key] = run
+        if self.directory:
+            os.makedirs(self.directory, exist_ok=True)
+            path = self._path(key)
+            temp_path = f"{path}.{os.getpid()}.tmp"
+            with open(temp_path, "w", encoding="utf-8") as file:
+                json.dump(run, file, ensure_ascii=False)
+            os.replace(temp_path, path)
+
+    # 質問と回答の結果を保存する（同じキーの結果は置き換え、フィードバックは引き継がない）
+    def save_results(self, persona_id, stage, variant, results):
+        run = {
+            "results": {category: [list(pair) for pair in pairs] for category, pairs in results.items()},
+            "feedbacks": [],
+            "updated_at": time.time(),
+        }
+        with self._lock:
+            self._write((persona_id, stage, variant), run)
+
+    # 保存済みの実行結果にフィードバックを追加する（実行結果が保存されていなければ何もしない）
+    def add_feedback(self, persona_id, stage, variant, feedback):
+        key = (persona_id, stage, variant)
+        with self._lock:
+            run = copy.deepcopy(self._load(key))
+            if run is None:
+                return
+            run["feedbacks"].append(feedback)
+            run["updated_at"] = time.time()
+            self._write(key, run)
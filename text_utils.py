@@ -0,0 +1,27 @@
+import re
+import unicodedata
+from collections import Counter
+
+# 文字n-gramの長さ（日本語は単語区切りがないため、辞書を使わず文字単位で索引を作る）
+NGRAM_SIZES = (2, 3)
+
+_SEPARATOR_PATTERN = re.compile(r"[\W_]+")
+
+
+# テキストを正規化（全角/半角・大文字/小文字の統一）し、記号や空白で区切った断片に分ける
+def _normalize_segments(text):
+    text = unicodedata.normalize("NFKC", text).lower()
+    return [segment for segment in _SEPARATOR_PATTERN.split(text) if segment]
+
+
+# テキストから文字n-gramの出現回数を数える（n より短い断片はそのまま1語として扱う）
+def char_ngrams(text, sizes=NGRAM_SIZES):
+    counts = Counter()
+    for segment in _normalize_segments(text):
+        if len(segment) < min(sizes):
+            counts[segment] += 1
+            continue
+        for n in sizes:
+            for i in range(len(segment) - n + 1):
+                counts[segment[i:i + n]] += 1
+    return counts
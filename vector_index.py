@@ -0,0 +1,292 @@
+import hashlib
+import json
+import os
+import re
+import threading
+import unicodedata
+import zlib
+from collections import deque
+
+import numpy as np
+
+from text_utils import char_ngrams
+
+# ハッシュ埋め込みの次元数と、使う文字n-gramの長さ
+HASHING_DIMENSION = 1024
+HASHING_NGRAM_SIZES = (1, 2, 3)
+# ベクトル検索で返すコサイン類似度の下限の既定値
+DEFAULT_MIN_SIMILARITY = 0.1
+# 類似質問キャッシュで過去の回答を再利用するコサイン類似度の下限（環境変数 DX_SEMANTIC_CACHE_THRESHOLD で変更可能）
+SEMANTIC_CACHE_THRESHOLD = float(os.environ.get("DX_SEMANTIC_CACHE_THRESHOLD", "0.85"))
+
+_HIRAGANA_PATTERN = re.compile(r"^[\u3040-\u309fー]+$")
+# 内容語（漢字・カタカナ・英数字の連続）
+_CONTENT_WORD_PATTERN = re.compile(r"[\u4e00-\u9fff々]+|[\u30a0-\u30ffー]+|[a-z0-9]+")
+
+
+# 行ごとにL2ノルムが1になるよう正規化する（ゼロベクトルはそのまま）
+def normalize_rows(matrix):
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return matrix / norms
+
+
+# オフラインで使える埋め込み: 文字n-gramを固定次元にハッシュしたTF（対数で重み付け）のベクトル
+# 文書側のベクトルは語彙やIDFに依存しないため、同じテキストは常に同じベクトルになる
+# （チャンク単位で個別に計算・保存できる）。IDFはインデックス構築時に次元ごとの文書頻度から求め、
+# クエリ側のベクトルに掛けることでTF-IDFに近い重み付けにする
+# hiragana_weight を1より小さくすると、ひらがなだけのn-gram（「の」「ように」など助詞・語尾が中心）の重みを下げ、
+# 内容語（漢字・カタカナ・英数字）の一致を重視した類似度になる
+class HashingEmbedder:
+    def __init__(self, dimension=HASHING_DIMENSION, sizes=HASHING_NGRAM_SIZES, hiragana_weight=1.0):
+        self.dimension = dimension
+        self.sizes = sizes
+        self.hiragana_weight = hiragana_weight
+        self.name = f"hashing-{dimension}-{'-'.join(map(str, sizes))}"
+        if hiragana_weight != 1.0:
+            self.name += f"-h{hiragana_weight}"
+
+    def embed(self, texts):
+        vectors = np.zeros((len(texts), self.dimension), dtype=np.float32)
+        for row, text in enumerate(texts):
+            for gram, count in char_ngrams(text, self.sizes).items():
+                weight = self.hiragana_weight if _HIRAGANA_PATTERN.match(gram) else 1.0
+                vectors[row, zlib.crc32(gram.encode("utf-8")) % self.dimension] += weight * (1 + np.log(count))
+        return normalize_rows(vectors)
+
+    # 文書の埋め込み行列から、クエリ側に掛ける次元ごとの重み（IDFの2乗）を求める
+    def query_weights(self, matrix):
+        document_frequency = np.count_nonzero(matrix, axis=0)
+        idf = np.log((1 + len(matrix)) / (1 + document_frequency)) + 1
+        return (idf * idf).astype(np.float32)
+
+
+# OpenAIの埋め込みAPIを使う場合の埋め込み（ネットワーク接続とAPIキーが必要）
+class OpenAIEmbedder:
+    def __init__(self, model="text-embedding-3-small"):
+        self.model = model
+        self.name = f"openai-{model}"
+
+    def embed(self, texts):
+        from llm_utils import call_embedding
+
+        if not texts:
+            return np.zeros((0, 0), dtype=np.float32)
+        response = call_embedding(model=self.model, input=list(texts))
+        vectors = np.array([item["embedding"] for item in response["data"]], dtype=np.float32)
+        return normalize_rows(vectors)
+
+    # 学習済みの埋め込みなのでクエリ側の重み付けは行わない
+    def query_weights(self, matrix):
+        return None
+
+
+# 文書の埋め込みを連続したfloat32の行列として保持し、行列ベクトル積1回で類似度を計算するインデックス
+class VectorIndex:
+    def __init__(self, documents, embedder, matrix=None):
+        self.documents = list(documents)
+        self.embedder = embedder
+        if matrix is None:
+            matrix = embedder.embed(self.documents)
+        self.matrix = np.ascontiguousarray(matrix, dtype=np.float32)
+        self.weights = embedder.query_weights(self.matrix)
+
+    # クエリとのコサイン類似度が min_score 以上の文書を、類似度の高い順に (文書番号, 類似度) で最大 top_k 件返す
+    # rows に文書番号の配列を渡すと、その行だけを対象に類似度を計算する
+    def search(self, query, top_k, min_score=DEFAULT_MIN_SIMILARITY, rows=None):
+        if not self.documents or top_k <= 0:
+            return []
+        query_vector = self.embedder.embed([query])[0]
+        if self.weights is not None:
+            query_vector = query_vector * self.weights
+            norm = np.linalg.norm(query_vector)
+            if norm > 0:
+                query_vector /= norm
+        if rows is None:
+            rows = np.arange(len(self.documents))
+            scores = self.matrix @ query_vector
+        else:
+            scores = self.matrix[rows] @ query_vector
+
+        candidates = np.flatnonzero(scores >= min_score)
+        if len(candidates) > top_k:
+            candidates = candidates[np.argpartition(-scores[candidates], top_k - 1)[:top_k]]
+        candidates = candidates[np.argsort(-scores[candidates], kind="stable")]
+        return [(int(rows[i]), float(scores[i])) for i in candidates]
+
+
+# 名前から埋め込みを作る（環境変数 DX_RAG_EMBEDDER で "hashing"（既定）または "openai" を選ぶ）
+def create_embedder(name=None):
+    name = name or os.environ.get("DX_RAG_EMBEDDER", "hashing")
+    if name == "openai":
+        return OpenAIEmbedder()
+    return HashingEmbedder()
+
+
+# 埋め込みをディスクに保存し、次回以降はメモリマップで読み込むストア
+# ディレクトリ内のファイル構成:
+#   vectors.npy   … チャンクの埋め込み行列（float32。mmap_mode="r" で開くため複数プロセスで物理ページを共有できる）
+#   chunks.json   … 各行に対応するチャンクのメタデータ（テキストとそのハッシュなど）
+#   manifest.json … 埋め込みの種類・次元数・チャンクのハッシュ一覧（内容が変わったかどうかの判定に使う）
+# テキストが変わったチャンクだけを埋め込み直し、変わっていないチャンクは保存済みのベクトルを再利用する
+class EmbeddingStore:
+    VECTORS_FILE = "vectors.npy"
+    CHUNKS_FILE = "chunks.json"
+    MANIFEST_FILE = "manifest.json"
+
+    def __init__(self, directory, embedder):
+        self.directory = directory
+        self.embedder = embedder
+
+    def _path(self, name):
+        return os.path.join(self.directory, name)
+
+    # 保存済みのマニフェストを読み込む（なければ None）
+    def _read_manifest(self):
+        try:
+            with open(self._path(self.MANIFEST_FILE), "r", encoding="utf-8") as file:
+                return json.load(file)
+        except (OSError, ValueError):
+            return None
+
+    # 一時ファイルに書き込んでから置き換える（読み込み中の他プロセスが壊れたファイルを見ないようにする）
+    def _replace(self, name, write):
+        temp_path = self._path(f".{name}.{os.getpid()}.tmp")
+        with open(temp_path, "wb") as file:
+            write(file)
+        os.replace(temp_path, self._path(name))
+
+    # チャンクの埋め込み行列を返す。保存済みの内容と一致すればメモリマップで開くだけで済む
+    def load(self, chunks):
+        texts = [chunk["text"] for chunk in chunks]
+        hashes = [hashlib.sha256(text.encode("utf-8")).hexdigest() for text in texts]
+        manifest = self._read_manifest()
+
+        if manifest and manifest.get("embedder") == self.embedder.name and manifest.get("chunk_hashes") == hashes:
+            try:
+                return np.load(self._path(self.VECTORS_FILE), mmap_mode="r")
+            except (OSError, ValueError):
+                pass
+
+        # 保存済みのベクトルのうち、テキストが変わっていないチャンクの分は再利用する
+        old_vectors = None
+        reusable = {}
+        if manifest and manifest.get("embedder") == self.embedder.name:
+            try:
+                old_vectors = np.load(self._path(self.VECTORS_FILE), mmap_mode="r")
+                reusable = {
+                    content_hash: row
+                    for row, content_hash in enumerate(manifest.get("chunk_hashes", []))
+                    if row < len(old_vectors)
+                }
+            except (OSError, ValueError):
+                old_vectors = None
+
+        missing = [i for i, content_hash in enumerate(hashes) if content_hash not in reusable]
+        if missing:
+            new_vectors = self.embedder.embed([texts[i] for i in missing])
+            dimension = new_vectors.shape[1]
+        else:
+            dimension = old_vectors.shape[1] if old_vectors is not None else 0
+
+        matrix = np.zeros((len(texts), dimension), dtype=np.float32)
+        for i, content_hash in enumerate(hashes):
+            if content_hash in reusable:
+                matrix[i] = old_vectors[reusable[content_hash]]
+        if missing:
+            matrix[missing] = new_vectors
+        del old_vectors
+
+        os.makedirs(self.directory, exist_ok=True)
+        self._replace(self.VECTORS_FILE, lambda file: np.save(file, matrix))
+        metadata = [dict(chunk, hash=content_hash) for chunk, content_hash in zip(chunks, hashes)]
+        self._replace(self.CHUNKS_FILE, lambda file: file.write(json.dumps(metadata, ensure_ascii=False).encode("utf-8")))
+        manifest = {
+            "embedder": self.embedder.name,
+            "dimension": int(dimension),
+            "count": len(texts),
+            "chunk_hashes": hashes,
+            "reembedded": len(missing),
+        }
+        self._replace(self.MANIFEST_FILE, lambda file: file.write(json.dumps(manifest, ensure_ascii=False).encode("utf-8")))
+        return np.load(self._path(self.VECTORS_FILE), mmap_mode="r")
+
+
+# 質問の内容語（漢字・カタカナ・英数字の連続）の集合。表記ゆれ（全角/半角・大文字/小文字）はそろえる
+def content_words(text):
+    return frozenset(_CONTENT_WORD_PATTERN.findall(unicodedata.normalize("NFKC", text).lower()))
+
+
+# 回答済みの質問をベクトルで保持し、言い換えられた質問に過去の回答を再利用するキャッシュ
+# スコープ（ペルソナの職業・DX推進ステージなど）ごとに質問の埋め込み行列を持ち、
+# 内容語が同じ質問のうち、コサイン類似度が最も高く threshold 以上のものがあれば保存済みの回答を返す
+# 文字n-gramの埋め込みでは「KPIを設定」と「予算を設定」のように1語だけ違う質問も類似度が高くなるため、
+# 類似度だけでなく内容語の一致も条件にする（言い換えで変わるのは助詞・語尾などのひらがなの部分だけとみなす）
+# 判定のたびに最も近い質問との類似度を記録し、ヒット率と類似度の分布を stats() で確認できる
+class SemanticAnswerCache:
+    def __init__(self, embedder=None, threshold=SEMANTIC_CACHE_THRESHOLD, max_entries_per_scope=1000):
+        self.embedder = embedder or HashingEmbedder(sizes=(1, 2), hiragana_weight=0.1)
+        self.threshold = threshold
+        self.max_entries_per_scope = max_entries_per_scope
+        self.hits = 0
+        self.misses = 0
+        self.similarities = deque(maxlen=1000)  # 直近の判定での最大類似度
+        self._scopes = {}  # スコープ -> {"matrix", "count", "questions", "words", "answers"}
+        self._lock = threading.Lock()
+
+    # 類似した質問の回答があれば (回答, 類似度) を、なければ (None, 最大類似度) を返す
+    # 最大類似度は内容語が同じ質問の中での値（該当する質問がなければ 0）
+    def lookup(self, scope, question):
+        vector = self.embedder.embed([question])[0]
+        words = content_words(question)
+        with self._lock:
+            entry = self._scopes.get(scope)
+            best, similarity = None, 0.0
+            if entry and entry["count"]:
+                scores = entry["matrix"][:entry["count"]] @ vector
+                matching = [i for i, entry_words in enumerate(entry["words"]) if entry_words == words]
+                if matching:
+                    best = max(matching, key=lambda i: scores[i])
+                    similarity = float(scores[best])
+            self.similarities.append(similarity)
+            if best is not None and similarity >= self.threshold:
+                self.hits += 1
+                return entry["answers"][best], similarity
+            self.misses += 1
+            return None, similarity
+
+    # 回答済みの質問と回答を登録する（行列は容量を倍々に広げて確保する）
+    def add(self, scope, question, answer):
+        vector = self.embedder.embed([question])[0]
+        with self._lock:
+            entry = self._scopes.setdefault(
+                scope,
+                {"matrix": np.zeros((16, len(vector)), dtype=np.float32), "count": 0, "questions": [], "words": [], "answers": []},
+            )
+            if entry["count"] >= self.max_entries_per_scope:
+                return
+            if entry["count"] == len(entry["matrix"]):
+                entry["matrix"] = np.vstack([entry["matrix"], np.zeros_like(entry["matrix"])])
+            entry["matrix"][entry["count"]] = vector
+            entry["count"] += 1
+            entry["questions"].append(question)
+            entry["words"].append(content_words(question))
+            entry["answers"].append(answer)
+
+    # ヒット数・ミス数・ヒット率と、最大類似度の分布（平均・パーセンタイル）を返す
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            similarities = np.array(self.similarities, dtype=np.float32)
+            stats = {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / total if total else 0.0,
+                "threshold": self.threshold,
+                "entries": sum(entry["count"] for entry in self._scopes.values()),
+            }
+            if len(similarities):
+                stats["similarity_mean"] = float(similarities.mean())
+                for percentile in (50, 90, 99):
+                    stats[f"similarity_p{percentile}"] = float(np.percentile(similarities, percentile))
+            return stats